@@ -1,8 +1,12 @@
+import argparse
+import hashlib
 import json
 
 import numpy as np
 import pandas as pd
 
+from coda_means import ALL, SNAPSHOT_DIRECTORY, CodaMeansStore
+
 rhythm = {
     "1+1+3": 5,
     "1+31": 4,
@@ -43,33 +47,112 @@ rhythm = {
 
 
 def standardize(dataframe, len):
-    sums = np.sum(dataframe.values[:, :len], axis=1).reshape(-1, 1)
-    denom = np.concatenate([sums for _ in range(len)], axis=1)
-    cumsum = np.cumsum(dataframe.values[:, :len] / denom, axis=1)
+    values = dataframe.values[:, :len]
+    cumsum = np.cumsum(values / values.sum(axis=1, keepdims=True), axis=1)
     return np.concatenate([np.zeros((cumsum.shape[0], 1)), cumsum], axis=1)
 
 
-def get_coda_data(path="data/DominicaCodas.csv"):
-    codas = pd.read_csv(path)
-    codas["CodaTypeConverted"] = [rhythm[v] for v in codas["CodaType"]]
+def get_coda_positions(codas, lengths=None):
+    """Coda ids and standardised click positions of the codas of a table
+
+    lengths fixes the number of intervals of coda types already in a store, by
+    default the shortest coda of each type sets it. Noise codas are dropped.
+    """
+    codas = codas.assign(
+        CodaTypeConverted=[rhythm[v] for v in codas["CodaType"]]
+    ).query("CodaTypeConverted != -1")
     codas_groups = dict(
         tuple(codas.groupby("CodaTypeConverted")[[f"ICI{i+1}" for i in range(9)]])
     )
+    positions = {}
+    for k, v in codas_groups.items():
+        n_icis = np.sum(v.values != 0, 1)
+        length = (lengths or {}).get(str(k), np.min(n_icis))
+        if np.min(n_icis) < length:
+            raise ValueError(
+                f"coda type {k} has codas with fewer than the {length} intervals "
+                "of its template, rebuild the means without --add"
+            )
+        positions[k] = standardize(v, length)
+    return codas, positions
+
+
+def check_columns(codas, path, group_columns):
+    """Raises a ValueError naming the columns a coda table lacks"""
+    required = ["CodaType"] + [f"ICI{i+1}" for i in range(9)] + list(group_columns)
+    missing = [col for col in required if col not in codas.columns]
+    if missing:
+        raise ValueError(f"{path} lacks the columns {', '.join(missing)}")
+
+
+def update_store(store, codas):
     lengths = {
-        k: (np.min(np.sum(v.values != 0, 1)), np.max(np.sum(v.values != 0, 1)))
-        for k, v in codas_groups.items()
-    }
-    standardised = {
-        k: standardize(v, lengths[k][0]) for k, v in codas_groups.items() if k != -1
+        coda: len(running.mean) - 1
+        for coda, running in store.templates.get(ALL, {}).items()
     }
-    means = {k: v.mean(axis=0) for k, v in standardised.items()}
-    means_trimmed = {k: v[1:] for k, v in means.items()}
+    codas, positions = get_coda_positions(codas, lengths)
+    store.update(
+        codas["CodaTypeConverted"].values,
+        positions,
+        {col: codas[col].values for col in store.group_columns},
+    )
+    return len(codas)
+
+
+def get_coda_data(path="data/DominicaCodas.csv"):
+    store = CodaMeansStore()
+    update_store(store, pd.read_csv(path))
+    return {int(k): v for k, v in store.means().items()}
 
-    return means_trimmed
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
 if __name__ == "__main__":
-    dialogues = pd.read_csv("data/sperm-whale-dialogues.csv")
-    means = get_coda_data()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--add",
+        nargs="+",
+        default=None,
+        help="annotated coda tables added to the latest snapshot, instead of "
+        "rebuilding the means from data/DominicaCodas.csv",
+    )
+    parser.add_argument("--snapshot-directory", default=SNAPSHOT_DIRECTORY)
+    parser.add_argument(
+        "--group-columns",
+        nargs="*",
+        default=None,
+        help="columns the templates are also grouped by, Clan and Unit by default; "
+        "with --add, those of the snapshot are used",
+    )
+    args = parser.parse_args()
+    if args.add is not None and args.group_columns is not None:
+        parser.error(
+            "--group-columns cannot be used with --add, the snapshot fixes the "
+            "group columns"
+        )
+
+    if args.add is None:
+        group_columns = (
+            ["Clan", "Unit"] if args.group_columns is None else args.group_columns
+        )
+        store, paths = CodaMeansStore(group_columns), ["data/DominicaCodas.csv"]
+    else:
+        store, paths = CodaMeansStore.load(args.snapshot_directory), args.add
+    tables = []
+    for path in paths:
+        digest = hash_file(path)
+        if any(source["sha256"] == digest for source in store.sources):
+            raise ValueError(f"{path} was already added to the coda means")
+        codas = pd.read_csv(path)
+        check_columns(codas, path, store.group_columns)
+        tables.append((path, digest, codas))
+    for path, digest, codas in tables:
+        n = update_store(store, codas)
+        store.sources.append({"path": path, "sha256": digest, "codas": n})
+    snapshot = store.save(args.snapshot_directory)
     with open("data/coda-means.json", "w") as f:
-        f.write(json.dumps({k: list(v) for k, v in means.items()}))
+        f.write(json.dumps({k: list(v) for k, v in store.means().items()}))
+    print(f"Wrote {snapshot} with templates for {len(store.groups())} groups")
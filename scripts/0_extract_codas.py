@@ -1,24 +1,257 @@
+import argparse
+import hashlib
+import heapq
+import itertools
 import json
-import random
-import string
+import multiprocessing
+import time
+from array import array
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import (cosine_distances, euclidean_distances,
-                                      manhattan_distances)
 
+from coda_means import ALL, load_means
+from schema import DTYPES, ORNAMENTATION, UNKNOWN, conform
+from segmentation_cache import SegmentationCache
+from tables import FORMATS, TableWriter, read_table_chunks
 
-class TreeNode:
-    def __init__(self, val):
-        self.name = "".join(
-            random.choice(string.ascii_letters + string.digits) for _ in range(16)
+
+class ExtractionCounters:
+    """Counts of the work done while segmenting the current vocalization"""
+
+    NAMES = [
+        "tree_nodes",
+        "dp_nodes",
+        "bnb_nodes",
+        "distance_calls",
+        "distances",
+        "candidates_accepted",
+        "candidates_rejected",
+        "backoff_steps",
+        "max_backoff_depth",
+    ]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.values = dict.fromkeys(self.NAMES, 0)
+
+    def count(self, name, n=1):
+        self.values[name] += n
+
+    def backoff(self, depth):
+        self.values["backoff_steps"] += 1
+        self.values["max_backoff_depth"] = max(self.values["max_backoff_depth"], depth)
+
+
+# set by init_worker when extraction is instrumented, None otherwise so that
+# the hot paths only pay for a global lookup
+extraction_counters = None
+
+
+class ExtractionReport:
+    """Totals of the extraction counters and the slowest vocalizations"""
+
+    def __init__(self, top=20):
+        self.top = top
+        self.totals = dict.fromkeys(ExtractionCounters.NAMES, 0)
+        self.vocalizations, self.seconds = 0, 0.0
+        self.slowest = []
+
+    def add(self, indices, sequences, records):
+        for index, sequence, record in zip(indices, sequences, records):
+            self.vocalizations += 1
+            self.seconds += record["seconds"]
+            for name in ExtractionCounters.NAMES:
+                if name == "max_backoff_depth":
+                    self.totals[name] = max(self.totals[name], record[name])
+                else:
+                    self.totals[name] += record[name]
+            self.slowest.append(
+                {"vocalization": index, "icis": list(map(float, sequence)), **record}
+            )
+        self.slowest = sorted(self.slowest, key=lambda x: -x["seconds"])[: self.top]
+
+    def to_dict(self):
+        return {
+            "vocalizations": self.vocalizations,
+            "seconds": self.seconds,
+            **self.totals,
+            "slowest": self.slowest,
+        }
+
+    def to_prometheus(self):
+        lines = []
+
+        def metric(name, type_, value, labels=""):
+            lines.append(f"# TYPE whalegpt_extraction_{name} {type_}")
+            lines.append(f"whalegpt_extraction_{name}{labels} {value}")
+
+        metric("vocalizations_total", "counter", self.vocalizations)
+        metric("seconds_total", "counter", self.seconds)
+        for name, value in self.totals.items():
+            if name == "max_backoff_depth":
+                metric(name, "gauge", value)
+            else:
+                metric(f"{name}_total", "counter", value)
+        lines.append("# TYPE whalegpt_extraction_slowest_vocalization_seconds gauge")
+        for record in self.slowest:
+            lines.append(
+                "whalegpt_extraction_slowest_vocalization_seconds"
+                f'{{vocalization="{record["vocalization"]}",length="{record["length"]}"}} '
+                f'{record["seconds"]}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                f.write(json.dumps(self.to_dict(), indent=2))
+
+
+class SegmentationTree:
+    """Nodes of a coda tree, stored in parallel arrays indexed by node id
+
+    Children are linked lists of edges, as the tree builder can add the same
+    child to a node twice.
+    """
+
+    __slots__ = (
+        "coda",
+        "score",
+        "start",
+        "end",
+        "parent",
+        "first_edge",
+        "last_edge",
+        "edge_child",
+        "edge_next",
+    )
+
+    def __init__(self):
+        # coda ids are the keys of the coda means, and None for the root
+        self.coda = []
+        self.score = array("d")
+        self.start, self.end, self.parent = array("i"), array("i"), array("i")
+        self.first_edge, self.last_edge = array("i"), array("i")
+        self.edge_child, self.edge_next = array("i"), array("i")
+
+    def add(self, val):
+        if extraction_counters is not None:
+            extraction_counters.count("tree_nodes")
+        self.coda.append(val[0])
+        self.score.append(val[1])
+        self.start.append(val[2])
+        self.end.append(val[3])
+        self.parent.append(-1)
+        self.first_edge.append(-1)
+        self.last_edge.append(-1)
+        return len(self.coda) - 1
+
+    def add_child(self, index, child):
+        edge = len(self.edge_child)
+        self.edge_child.append(child)
+        self.edge_next.append(-1)
+        if self.last_edge[index] == -1:
+            self.first_edge[index] = edge
+        else:
+            self.edge_next[self.last_edge[index]] = edge
+        self.last_edge[index] = edge
+        self.parent[child] = index
+
+    def has_child(self, index, coda):
+        """Whether a child of the node at index has the given coda"""
+        edge = self.first_edge[index]
+        while edge != -1:
+            if self.coda[self.edge_child[edge]] == coda:
+                return True
+            edge = self.edge_next[edge]
+        return False
+
+    def child_indices(self, index):
+        children = []
+        edge = self.first_edge[index]
+        while edge != -1:
+            children.append(self.edge_child[edge])
+            edge = self.edge_next[edge]
+        return children
+
+    def best_leaf(self, root, extra_value=0.05):
+        """The leaf with the lowest score below root, and its score
+
+        Scores are accumulated from the root, and ties go to the leaf visited
+        first depth first, like sorting all paths by score would. The stack
+        holds the next edge to follow at each depth, so the edges are walked
+        in place.
+        """
+        coda, score = self.coda, self.score
+        first_edge, edge_child, edge_next = (
+            self.first_edge,
+            self.edge_child,
+            self.edge_next,
         )
-        self.children = []
-        self.val = val
+        root_score = extra_value if coda[root] == ORNAMENTATION else score[root]
+        if first_edge[root] == -1:
+            return root, root_score
+        best, best_score = None, None
+        stack = [(first_edge[root], root_score)]
+        while len(stack):
+            edge, parent_score = stack.pop()
+            if edge_next[edge] != -1:
+                stack.append((edge_next[edge], parent_score))
+            index = edge_child[edge]
+            path_score = parent_score + (
+                extra_value if coda[index] == ORNAMENTATION else score[index]
+            )
+            if first_edge[index] == -1:
+                if best is None or path_score < best_score:
+                    best, best_score = index, path_score
+            else:
+                stack.append((first_edge[index], path_score))
+        return best, best_score
+
+    def path(self, leaf, root):
+        """(coda, start, end) of the nodes from below root to leaf"""
+        path = []
+        while leaf != root:
+            path.append((self.coda[leaf], self.start[leaf], self.end[leaf]))
+            leaf = self.parent[leaf]
+        return path[::-1]
+
+
+class TreeNode:
+    """A node of a SegmentationTree, TreeNode(val) is the root of a new tree"""
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, val=None, tree=None, index=None):
+        if tree is None:
+            tree = SegmentationTree()
+            index = tree.add(val)
+        self.tree, self.index = tree, index
+
+    @property
+    def val(self):
+        tree, index = self.tree, self.index
+        return (tree.coda[index], tree.score[index], tree.start[index], tree.end[index])
+
+    @property
+    def children(self):
+        return [
+            TreeNode(tree=self.tree, index=child)
+            for child in self.tree.child_indices(self.index)
+        ]
+
+    def new_node(self, val):
+        """A new node of the same tree, to be added as a child"""
+        return TreeNode(tree=self.tree, index=self.tree.add(val))
 
     def addChild(self, tree_node):
-        assert tree_node.name != self.name
-        self.children.append(tree_node)
+        assert tree_node.tree is self.tree and tree_node.index != self.index
+        self.tree.add_child(self.index, tree_node.index)
 
     def str(self, indent):
         return f"{self.val}\n" + "\n".join(
@@ -42,48 +275,221 @@ class TreeNode:
             ]
         )
 
-    def get_best_path(self, first_call=True, path=[], score=0.0, extra_value=0.05):
-        new_path = path + [(self.val[0], self.val[2], self.val[3])]
-        if self.val[0] == 100:
-            new_score = score + extra_value
-        else:
-            new_score = score + self.val[1]
-        if len(self.children) == 0:
-            if not first_call:
-                return [(new_path, new_score)]
-            else:
-                return (new_path, new_score)
+    def get_best_path(self, extra_value=0.05):
+        leaf, score = self.tree.best_leaf(self.index, extra_value)
+        if leaf == self.index:
+            return ([(self.val[0], self.val[2], self.val[3])], score)
+        return (self.tree.path(leaf, self.index), score)
+
+
+class TemplateIndex:
+    """Templates of one coda length, for finding those near a window
+
+    The templates are sorted by their manhattan distance to a pivot template, so
+    by the triangle inequality only a contiguous range of them can be within
+    threshold of a window, found by binary search. The distances to further
+    pivots, chosen farthest first, rule out more templates of that range.
+    """
+
+    # bounds are loosened by this much, so that rounding never rules out a
+    # template whose distance is within threshold
+    TOLERANCE = 1e-9
+
+    def __init__(self, matrix, n_pivots=4):
+        pivots = [int(np.argmin(np.abs(matrix - matrix.mean(axis=0)).sum(axis=1)))]
+        while len(pivots) < min(n_pivots, len(matrix)):
+            nearest = self.pivot_distances(matrix, matrix[pivots]).min(axis=1)
+            pivots.append(int(np.argmax(nearest)))
+        self.pivots = matrix[pivots]
+        distances = self.pivot_distances(matrix, self.pivots)
+        self.order = np.argsort(distances[:, 0], kind="stable")
+        self.keys = distances[self.order, 0]
+        self.bounds = distances[self.order, 1:]
+
+    @staticmethod
+    def pivot_distances(vectors, pivots):
+        return np.abs(vectors[:, None, :] - pivots[None, :, :]).sum(axis=2)
+
+    def query(self, vectors, threshold):
+        """(row, template) pairs of vectors and templates that may be within threshold"""
+        distances = self.pivot_distances(vectors, self.pivots)
+        radius = threshold + self.TOLERANCE
+        low = np.searchsorted(self.keys, distances[:, 0] - radius, "left")
+        high = np.searchsorted(self.keys, distances[:, 0] + radius, "right")
+        if len(vectors) == 1:
+            # the common case of a single window needs no gather
+            positions = np.arange(low[0], high[0])
+            rows = np.zeros(len(positions), dtype=int)
         else:
-            children = [
-                child.get_best_path(False, new_path, new_score, extra_value)
-                for child in self.children
-            ]
-            children = [x for y in children for x in y]
-            children = sorted(children, key=lambda x: x[1])
-            if first_call:
-                return (children[0][0][1:], children[0][1])
+            counts = np.maximum(high - low, 0)
+            rows = np.repeat(np.arange(len(vectors)), counts)
+            offsets = np.repeat(np.cumsum(counts) - counts - low, counts)
+            positions = np.arange(len(rows)) - offsets
+        possible = (np.abs(distances[rows, 1:] - self.bounds[positions]) <= radius).all(
+            axis=1
+        )
+        return rows[possible], self.order[positions[possible]]
+
+
+class MeansMatrix:
+    """Coda means grouped into one matrix per coda length
+
+    Built once from coda-means.json, so that windows of a vocalization can be
+    scored against all coda types with a single NumPy operation per length.
+    Lengths with at least INDEX_MIN_TEMPLATES templates get a TemplateIndex, and
+    candidates() only scores the templates it can not rule out. Below that, a
+    scan of all templates is faster than the index lookups.
+    """
+
+    INDEX_MIN_TEMPLATES = 512
+
+    def __init__(self, means):
+        self.codas = [coda for coda in means.keys() if coda != UNKNOWN]
+        indices_by_length = {}
+        for index, coda in enumerate(self.codas):
+            indices_by_length.setdefault(len(means[coda]), []).append(index)
+        self.buckets = {
+            length: (
+                np.array(indices),
+                np.array([means[self.codas[i]] for i in indices], dtype=float),
+            )
+            for length, indices in sorted(indices_by_length.items())
+        }
+        self.indexes = {
+            length: TemplateIndex(matrix)
+            for length, (_, matrix) in self.buckets.items()
+            if len(matrix) >= self.INDEX_MIN_TEMPLATES
+        }
+
+    @staticmethod
+    def normalize(windows):
+        """Cumulative click positions of windows, and the count of positions at 1"""
+        sums = np.array([window.sum() for window in windows]).reshape(-1, 1)
+        normalized = np.cumsum(windows / sums, axis=1)
+        n_equal_one = np.cumsum(np.abs(normalized - 1.0) < 1e-10, axis=1)
+        return normalized, n_equal_one
+
+    @staticmethod
+    def applicable(n_equal_one, length, only_equal):
+        n = n_equal_one[:, length - 1]
+        return (n == 1) | ((n <= 1) & (not only_equal))
+
+    def distances(self, windows, only_equal=True):
+        """Manhattan distances of each window (row) to each coda, nan where a coda does not apply"""
+        windows = np.asarray(windows, dtype=float)
+        distances = np.full((windows.shape[0], len(self.codas)), np.nan)
+        if extraction_counters is not None:
+            extraction_counters.count("distance_calls")
+        if windows.shape[1] == 0:
+            return distances
+        normalized, n_equal_one = self.normalize(windows)
+        for length, (indices, matrix) in self.buckets.items():
+            if length > windows.shape[1]:
+                continue
+            if extraction_counters is not None:
+                extraction_counters.count("distances", windows.shape[0] * len(indices))
+            applicable = self.applicable(n_equal_one, length, only_equal)
+            deltas = np.abs(normalized[:, None, :length] - matrix[None, :, :])
+            # cumsum sums the deltas in order, matching the pairwise manhattan distance
+            distances[:, indices] = np.where(
+                applicable.reshape(-1, 1), np.cumsum(deltas, axis=2)[:, :, -1], np.nan
+            )
+        return distances
+
+    def ranked(self, distances, threshold=np.inf):
+        """Candidates (coda, distance) of a row of distances, sorted by distance"""
+        indices = np.flatnonzero(~np.isnan(distances))
+        n_applicable = len(indices)
+        indices = indices[distances[indices] <= threshold]
+        if extraction_counters is not None:
+            extraction_counters.count("candidates_accepted", len(indices))
+            extraction_counters.count(
+                "candidates_rejected", n_applicable - len(indices)
+            )
+        indices = indices[np.argsort(distances[indices], kind="stable")]
+        return [(self.codas[i], distances[i]) for i in indices]
+
+    def candidates(self, windows, threshold=0.1, only_equal=True):
+        """Ranked candidates of each window (row), the same as ranked(distances(window), threshold)"""
+        windows = np.asarray(windows, dtype=float)
+        if len(self.indexes) == 0:
+            distances = self.distances(windows, only_equal)
+            return [self.ranked(row, threshold) for row in distances]
+        if extraction_counters is not None:
+            extraction_counters.count("distance_calls")
+        if windows.shape[1] == 0:
+            return [[] for _ in windows]
+        normalized, n_equal_one = self.normalize(windows)
+        found, n_applicable = [], 0
+        for length, (indices, matrix) in self.buckets.items():
+            if length > windows.shape[1]:
+                continue
+            applicable = np.flatnonzero(
+                self.applicable(n_equal_one, length, only_equal)
+            )
+            if len(applicable) == 0:
+                continue
+            n_applicable += len(applicable) * len(indices)
+            if length in self.indexes:
+                rows, positions = self.indexes[length].query(
+                    normalized[applicable, :length], threshold
+                )
             else:
-                return children
+                rows = np.repeat(np.arange(len(applicable)), len(indices))
+                positions = np.tile(np.arange(len(indices)), len(applicable))
+            rows = applicable[rows]
+            # summed in order like distances(), so that both agree to the last bit
+            deltas = np.abs(normalized[rows, :length] - matrix[positions])
+            distances = np.cumsum(deltas, axis=1)[:, -1]
+            if extraction_counters is not None:
+                extraction_counters.count("distances", len(rows))
+            within = distances <= threshold
+            found.append((rows[within], indices[positions[within]], distances[within]))
+        if len(found) == 0:
+            return [[] for _ in windows]
+        rows, indices, distances = map(np.concatenate, zip(*found))
+        if extraction_counters is not None:
+            extraction_counters.count("candidates_accepted", len(rows))
+            extraction_counters.count("candidates_rejected", n_applicable - len(rows))
+        order = np.lexsort((indices, distances, rows))
+        candidates = [[] for _ in windows]
+        for row, index, distance in zip(rows[order], indices[order], distances[order]):
+            candidates[row].append((self.codas[index], distance))
+        return candidates
 
+    def window_candidates(self, sequence, max_length, threshold=0.1, only_equal=True):
+        """Ranked candidates for every window of up to max_length intervals, keyed by (start, end)"""
+        sequence = np.asarray(sequence, dtype=float)
+        candidates = {}
+        for length in range(1, min(max_length, len(sequence)) + 1):
+            windows = np.lib.stride_tricks.sliding_window_view(sequence, length)
+            ranked = self.candidates(windows, threshold, only_equal)
+            for start, window_candidates in enumerate(ranked):
+                candidates[(start, start + length)] = window_candidates
+        return candidates
+
+
+def as_means_matrix(means):
+    return means if isinstance(means, MeansMatrix) else MeansMatrix(means)
 
-def coda_distances(sequence, means, only_equal=True):
-    sequence_ = np.array(sequence)
-    distance = {}
-    for coda, mean in means.items():
-        if coda != -1 and len(sequence) >= len(mean):
-            sequence_normalized = np.cumsum(sequence_ / sequence_.sum())[: len(mean)]
-            n_equal_one = np.sum(np.abs(sequence_normalized - 1.0) < 1e-10)
-            if (n_equal_one <= 1 and not only_equal) or n_equal_one == 1:
-                distance[coda] = manhattan_distances(
-                    sequence_normalized.reshape(1, -1), mean.reshape(1, -1)
-                )[0][0]
 
-    return distance
+def coda_distances(sequence, means, only_equal=True):
+    means = as_means_matrix(means)
+    distances = means.distances(
+        np.array(sequence, dtype=float).reshape(1, -1), only_equal
+    )[0]
+    return {
+        coda: distance
+        for coda, distance in zip(means.codas, distances)
+        if not np.isnan(distance)
+    }
 
 
 def get_coda(sequence, means, only_equal=True):
-    distances = coda_distances(sequence, means, only_equal)
-    sorted_ = sorted(list(distances.items()), key=lambda x: x[1])
+    means = as_means_matrix(means)
+    sorted_ = means.ranked(
+        means.distances(np.array(sequence, dtype=float).reshape(1, -1), only_equal)[0]
+    )
     if len(sorted_):
         return sorted_[0]
     else:
@@ -91,12 +497,10 @@ def get_coda(sequence, means, only_equal=True):
 
 
 def get_candidates_sorted_filtered(sequence, means, threshold=0.1, only_equal=True):
-    distances = coda_distances(sequence, means, only_equal)
-    sorted_ = sorted(list(distances.items()), key=lambda x: x[1])
-    candidates = [
-        (coda, distance) for coda, distance in sorted_ if distance <= threshold
-    ]
-    return candidates
+    means = as_means_matrix(means)
+    return means.candidates(
+        np.array(sequence, dtype=float).reshape(1, -1), threshold, only_equal
+    )[0]
 
 
 def expand_tree(
@@ -110,37 +514,99 @@ def expand_tree(
     limit,
     threshold,
     only_equal,
+):
+    build_children(
+        tree.tree,
+        tree.index,
+        candidates,
+        sequence,
+        sequence_eval_index,
+        sequence_start,
+        means,
+        coda_lengths,
+        limit,
+        threshold,
+        only_equal,
+    )
+    return tree
+
+
+def get_coda_tree(
+    tree,
+    sequence,
+    sequence_eval_index,
+    sequence_start,
+    means,
+    coda_lengths,
+    limit=3,
+    threshold=0.1,
+    only_equal=True,
+    backoff_depth=0,
+):
+    build_tree(
+        tree.tree,
+        tree.index,
+        sequence,
+        sequence_eval_index,
+        sequence_start,
+        means,
+        coda_lengths,
+        limit,
+        threshold,
+        only_equal,
+        backoff_depth,
+    )
+    return tree
+
+
+# get_coda_tree and expand_tree build the tree below a TreeNode with the
+# functions below, which address the nodes of the SegmentationTree by index, so
+# that no TreeNode is created while the tree is built
+
+
+def build_children(
+    nodes,
+    index,
+    candidates,
+    sequence,
+    sequence_eval_index,
+    sequence_start,
+    means,
+    coda_lengths,
+    limit,
+    threshold,
+    only_equal,
 ):
     for candidate in candidates:
         sequence_length = min(len(sequence), coda_lengths[candidate[0]])
         sequence_end = sequence_start + sequence_length
         sequence_remainder = sequence[sequence_length:]
-        child = TreeNode(
-            (*candidate, sequence_start, sequence_end, sequence[:sequence_length])
-        )
+        child = nodes.add((*candidate, sequence_start, sequence_end))
         if len(sequence_remainder) > 1:
-            # tree, sequence, sequence_eval_index, means, coda_lengths, limit=3, threshold=0.1, only_equal=True
-            child = get_coda_tree(
-                tree=child,
-                sequence=sequence_remainder,
-                sequence_eval_index=sequence_eval_index,
-                sequence_start=sequence_end,
-                means=means,
-                coda_lengths=coda_lengths,
-                limit=limit,
-                threshold=threshold,
-                only_equal=only_equal,
-            )
-            tree.addChild(child)
+            build_tree(
+                nodes,
+                child,
+                sequence_remainder,
+                sequence_eval_index,
+                sequence_end,
+                means,
+                coda_lengths,
+                limit,
+                threshold,
+                only_equal,
+            )
+            nodes.add_child(index, child)
         elif len(sequence_remainder) == 1:
-            child.addChild(TreeNode((100, 1.0, sequence_end, sequence_end + 1)))
-        tree.addChild(child)
-
-    return tree
+            nodes.add_child(
+                child,
+                nodes.add((ORNAMENTATION, 1.0, sequence_end, sequence_end + 1)),
+            )
+        nodes.add_child(index, child)
 
 
-def get_coda_tree(
-    tree,
+def build_tree(
+    nodes,
+    index,
     sequence,
     sequence_eval_index,
     sequence_start,
@@ -149,106 +615,658 @@ def get_coda_tree(
     limit=3,
     threshold=0.1,
     only_equal=True,
+    backoff_depth=0,
 ):
     candidates = get_candidates_sorted_filtered(
         sequence[:sequence_eval_index], means, threshold, only_equal
     )[:limit]
     if len(candidates) > 0:
-        tree = expand_tree(
-            tree=tree,
-            candidates=candidates,
-            sequence=sequence,
-            sequence_eval_index=sequence_eval_index,
-            sequence_start=sequence_start,
-            means=means,
-            coda_lengths=coda_lengths,
-            limit=limit,
-            threshold=threshold,
-            only_equal=only_equal,
+        build_children(
+            nodes,
+            index,
+            candidates,
+            sequence,
+            sequence_eval_index,
+            sequence_start,
+            means,
+            coda_lengths,
+            limit,
+            threshold,
+            only_equal,
         )
     else:
-        if not 100 in [child.val[0] for child in tree.children]:
+        if not nodes.has_child(index, ORNAMENTATION):
             candidates1 = get_candidates_sorted_filtered(
                 sequence[1 : sequence_eval_index + 1], means, threshold, only_equal
             )
             if len(candidates1) > 0:
-                child1 = expand_tree(
-                    tree=TreeNode((100, 1.0, sequence_start, sequence_start + 1)),
-                    candidates=candidates1,
-                    sequence=sequence[1:],
-                    sequence_eval_index=sequence_eval_index,
-                    sequence_start=sequence_start + 1,
-                    means=means,
-                    coda_lengths=coda_lengths,
-                    limit=limit,
-                    threshold=threshold,
-                    only_equal=only_equal,
+                child1 = nodes.add(
+                    (ORNAMENTATION, 1.0, sequence_start, sequence_start + 1)
+                )
+                build_children(
+                    nodes,
+                    child1,
+                    candidates1,
+                    sequence[1:],
+                    sequence_eval_index,
+                    sequence_start + 1,
+                    means,
+                    coda_lengths,
+                    limit,
+                    threshold,
+                    only_equal,
                 )
-                tree.addChild(child1)
+                nodes.add_child(index, child1)
 
         if sequence_eval_index > 1:
-            child2 = get_coda_tree(
-                tree=tree,
-                sequence=sequence,
-                sequence_eval_index=sequence_eval_index - 1,
-                sequence_start=sequence_start,
-                means=means,
-                coda_lengths=coda_lengths,
-                limit=limit,
-                threshold=threshold,
-                only_equal=only_equal,
+            if extraction_counters is not None:
+                extraction_counters.backoff(backoff_depth + 1)
+            build_tree(
+                nodes,
+                index,
+                sequence,
+                sequence_eval_index - 1,
+                sequence_start,
+                means,
+                coda_lengths,
+                limit,
+                threshold,
+                only_equal,
+                backoff_depth + 1,
             )
-    return tree
 
 
-if __name__ == "__main__":
-    dialogues = pd.read_csv("data/sperm-whale-dialogues.csv")
+def get_coda_children(
+    sequence,
+    sequence_eval_index,
+    sequence_start,
+    means,
+    coda_lengths,
+    limit,
+    threshold,
+    only_equal,
+    candidates_cache,
+):
+    def candidates_for(start, end):
+        end = min(end, len(sequence))
+        if (start, end) not in candidates_cache:
+            candidates_cache[(start, end)] = get_candidates_sorted_filtered(
+                sequence[start:end], means, threshold, only_equal
+            )
+        return candidates_cache[(start, end)]
 
-    with open("data/coda-means.json", "r") as f:
-        means = json.loads(f.read())
-        means = {k: np.array(v) for k, v in means.items()}
-        coda_lengths = {k: len(v) for k, v in means.items()}
+    def expand_children(candidates, start, eval_index):
+        return [
+            (
+                coda,
+                distance,
+                start,
+                start + min(len(sequence) - start, coda_lengths[coda]),
+                eval_index,
+            )
+            for coda, distance in candidates
+        ]
 
-    results = {}
-    for i in range(dialogues.shape[0]):
-        sequence = np.array(
-            list(dialogues[[f"ICI{i+1}" for i in range(28)]].values[i, :])
+    # mirrors the back-off in get_coda_tree: shrink the evaluation window until
+    # candidates are found, adding at most one ornamentation (100) branch on the way
+    children = []
+    ornamentation_added = False
+    for eval_index in range(sequence_eval_index, 0, -1):
+        candidates = candidates_for(sequence_start, sequence_start + eval_index)[:limit]
+        if len(candidates) > 0:
+            children.extend(expand_children(candidates, sequence_start, eval_index))
+            break
+        if extraction_counters is not None and eval_index > 1:
+            extraction_counters.backoff(sequence_eval_index - eval_index + 1)
+        if not ornamentation_added:
+            candidates1 = candidates_for(
+                sequence_start + 1, sequence_start + 1 + eval_index
+            )
+            if len(candidates1) > 0:
+                children.append(
+                    (
+                        ORNAMENTATION,
+                        expand_children(candidates1, sequence_start + 1, eval_index),
+                        sequence_start,
+                        sequence_start + 1,
+                        eval_index,
+                    )
+                )
+                ornamentation_added = True
+    return children
+
+
+class SegmentationSpace:
+    """The nodes below which get_coda_tree would build identical subtrees
+
+    Nodes are (coda, distance, start, end, eval_index) tuples, except for
+    ornamentation nodes, which carry their already expanded children in place of
+    the distance. children(node) lists the children of a node in the order in
+    which get_coda_tree adds them.
+    """
+
+    def __init__(
+        self,
+        sequence,
+        sequence_eval_index,
+        means,
+        coda_lengths,
+        limit,
+        threshold,
+        only_equal,
+        precompute=True,
+    ):
+        self.sequence = list(sequence)
+        self.sequence_eval_index = sequence_eval_index
+        self.means = as_means_matrix(means)
+        self.coda_lengths = coda_lengths
+        self.limit = limit
+        self.threshold = threshold
+        self.only_equal = only_equal
+        # candidates of all windows at once are cheaper per window, but searches
+        # that only visit some windows compute them as they are needed
+        self.candidates_cache = {}
+        if precompute:
+            self.candidates_cache = self.means.window_candidates(
+                self.sequence, sequence_eval_index, threshold, only_equal
+            )
+
+    def children_of(self, start, eval_index):
+        return get_coda_children(
+            self.sequence,
+            eval_index,
+            start,
+            self.means,
+            self.coda_lengths,
+            self.limit,
+            self.threshold,
+            self.only_equal,
+            self.candidates_cache,
         )
-        sequence = sequence[sequence > 0]
+
+    def root_children(self):
+        return self.children_of(0, self.sequence_eval_index)
+
+    @staticmethod
+    def key(node):
+        # ornamentation nodes carry their expanded children in position 1
+        return (node[0], None if node[0] == ORNAMENTATION else node[1], *node[2:])
+
+    def children(self, node):
+        coda, value, start, end, eval_index = node
+        if coda == ORNAMENTATION and isinstance(value, list):
+            return value
+        if coda == ORNAMENTATION:
+            return []
+        remainder = len(self.sequence) - end
+        if remainder > 1:
+            return self.children_of(end, eval_index)
+        elif remainder == 1:
+            return [(ORNAMENTATION, None, end, end + 1, eval_index)]
+        return []
+
+
+def get_best_path_dp(
+    sequence,
+    sequence_eval_index,
+    means,
+    coda_lengths,
+    limit=3,
+    threshold=0.1,
+    only_equal=True,
+    extra_value=0.05,
+):
+    """Exact replacement for get_coda_tree(...).get_best_path(...)
+
+    The subtree below a node only depends on its coda, start, end and evaluation
+    index, so instead of enumerating every path, nodes sharing these values are
+    merged and only the best path into each of them is kept (Viterbi). Scores are
+    accumulated from the root like in TreeNode.get_best_path, and ties are broken
+    by the order in which the tree would have visited the paths.
+    """
+    space = SegmentationSpace(
+        sequence, sequence_eval_index, means, coda_lengths, limit, threshold, only_equal
+    )
+    node_key, node_children = space.key, space.children
+    root_children = space.root_children()
+    if len(root_children) == 0:
+        return ([(None, 0, 0)], 0.0)
+
+    # nodes always start after their parent, so processing them by start position
+    # visits every parent before its children
+    buckets = [{} for _ in range(len(space.sequence) + 1)]
+    best = {}
+
+    def relax(node, score, order, parent):
+        key = node_key(node)
+        new_score = score + (extra_value if node[0] == ORNAMENTATION else node[1])
+        if key not in best or (new_score, order) < best[key][:2]:
+            best[key] = (new_score, order, parent, node)
+            buckets[node[2]][key] = node
+
+    for j, child in enumerate(root_children):
+        relax(child, 0.0, (j,), None)
+
+    best_leaf = None
+    for bucket in buckets:
+        for key, node in bucket.items():
+            score, order, _, _ = best[key]
+            children = node_children(node)
+            if len(children) == 0:
+                if best_leaf is None or (score, order) < best[best_leaf][:2]:
+                    best_leaf = key
+            for j, child in enumerate(children):
+                relax(child, score, order + (j,), key)
+
+    if extraction_counters is not None:
+        extraction_counters.count("dp_nodes", len(best))
+
+    path = []
+    key = best_leaf
+    while key is not None:
+        _, _, parent, node = best[key]
+        path.append((node[0], node[2], node[3]))
+        key = parent
+    return (path[::-1], best[best_leaf][0])
+
+
+def get_best_path_bnb(
+    sequence,
+    sequence_eval_index,
+    means,
+    coda_lengths,
+    limit=3,
+    threshold=0.1,
+    only_equal=True,
+    extra_value=0.05,
+    max_nodes=None,
+    max_seconds=None,
+):
+    """Anytime best-first search for the path of get_best_path_dp
+
+    Returns (path, score, optimal). Nodes are expanded in order of (score, order),
+    where the partial score is a lower bound of every path through the node, as
+    distances and extra_value are not negative. The first complete path reached
+    is therefore the one get_best_path_dp returns, ties included. A greedy dive
+    along the best ranked candidates provides a complete path up front, and nodes
+    that can not improve on the best complete path are pruned. When max_nodes
+    nodes were expanded or max_seconds passed, the best complete path found so
+    far is returned with optimal set to False.
+    """
+    start_time = time.perf_counter()
+    space = SegmentationSpace(
+        sequence,
+        sequence_eval_index,
+        means,
+        coda_lengths,
+        limit,
+        threshold,
+        only_equal,
+        precompute=False,
+    )
+    root_children = space.root_children()
+    if len(root_children) == 0:
+        return ([(None, 0, 0)], 0.0, True)
+
+    def entry(score, order, node, link):
+        score = score + (extra_value if node[0] == ORNAMENTATION else node[1])
+        return (score, order, node, ((node[0], node[2], node[3]), link))
+
+    def dive(score, order, node, link):
+        children = space.children(node)
+        while len(children):
+            score, order, node, link = entry(score, order + (0,), children[0], link)
+            children = space.children(node)
+        return (score, order, link)
+
+    frontier = [entry(0.0, (j,), child, None) for j, child in enumerate(root_children)]
+    heapq.heapify(frontier)
+    incumbent = dive(*frontier[0])
+    expanded = set()
+    optimal = True
+    while len(frontier) and frontier[0][:2] < incumbent[:2]:
+        if (max_nodes is not None and len(expanded) >= max_nodes) or (
+            max_seconds is not None and time.perf_counter() - start_time > max_seconds
+        ):
+            # complete the most promising partial path before giving up
+            incumbent = min(incumbent, dive(*frontier[0]), key=lambda x: x[:2])
+            optimal = False
+            break
+        score, order, node, link = heapq.heappop(frontier)
+        # the first expansion of a node is its best, as in get_best_path_dp
+        key = space.key(node)
+        if key in expanded:
+            continue
+        expanded.add(key)
+        children = space.children(node)
+        if len(children) == 0:
+            incumbent = (score, order, link)
+            break
+        for j, child in enumerate(children):
+            child_entry = entry(score, order + (j,), child, link)
+            if child_entry[:2] < incumbent[:2]:
+                heapq.heappush(frontier, child_entry)
+
+    if extraction_counters is not None:
+        extraction_counters.count("bnb_nodes", len(expanded))
+
+    score, _, link = incumbent
+    path = []
+    while link is not None:
+        step, link = link
+        path.append(step)
+    return (path[::-1], score, optimal)
+
+
+def segment_vocalization(
+    sequence,
+    means,
+    coda_lengths,
+    engine="dp",
+    limit=100,
+    threshold=0.1,
+    only_equal=True,
+    extra_value=0.05,
+    max_nodes=None,
+    max_seconds=None,
+):
+    """The best path of a sequence, and with the bnb engine whether it is optimal"""
+    if engine == "bnb":
+        return get_best_path_bnb(
+            list(sequence),
+            9,
+            means,
+            coda_lengths,
+            limit=limit,
+            threshold=threshold,
+            only_equal=only_equal,
+            extra_value=extra_value,
+            max_nodes=max_nodes,
+            max_seconds=max_seconds,
+        )
+    elif engine == "dp":
+        return get_best_path_dp(
+            list(sequence),
+            9,
+            means,
+            coda_lengths,
+            limit=limit,
+            threshold=threshold,
+            only_equal=only_equal,
+            extra_value=extra_value,
+        )
+    else:
         tree = get_coda_tree(
             TreeNode((None, 0.0, 0, 0)),
             list(sequence),
             9,
             0,
             means,
-            {k: len(v) for k, v in means.items()},
-            limit=100,
-            threshold=0.1,
+            coda_lengths,
+            limit=limit,
+            threshold=threshold,
+            only_equal=only_equal,
         )
-        results[i] = (tree.get_best_path(extra_value=0.05), sequence)
+        return tree.get_best_path(extra_value=extra_value)
+
+
+# set once per worker process by init_worker, so that the means are not sent with every task
+worker_state = {}
+
+
+def init_worker(means, kwargs, instrument=False):
+    global extraction_counters
+    worker_state["means"] = MeansMatrix(means)
+    worker_state["coda_lengths"] = {k: len(v) for k, v in means.items()}
+    worker_state["kwargs"] = kwargs
+    extraction_counters = ExtractionCounters() if instrument else None
+
+
+def segment_vocalization_worker(sequence):
+    """The best path of a sequence, and its counters if instrumented"""
+    if extraction_counters is not None:
+        extraction_counters.reset()
+        start = time.perf_counter()
+    best_path = segment_vocalization(
+        sequence,
+        worker_state["means"],
+        worker_state["coda_lengths"],
+        **worker_state["kwargs"],
+    )
+    if extraction_counters is None:
+        return best_path
+    record = {
+        "seconds": time.perf_counter() - start,
+        "length": len(sequence),
+        **extraction_counters.values,
+    }
+    return best_path, record
+
+
+def segment_batches(
+    batches, means, workers=1, chunksize=16, cache=None, report=None, **kwargs
+):
+    """Yields the best paths of each batch of sequences, in input order
+
+    With workers > 1, sequences are distributed over a process pool in chunks of
+    chunksize; the pool is kept for all batches. With a cache, only the sequences
+    missing from it are segmented. With an ExtractionReport, the segmentation is
+    instrumented and the counters of every segmented sequence are added to it.
+    """
+    instrument = report is not None
+    if workers <= 1:
+        init_worker(means, kwargs, instrument)
+        segment = lambda sequences: list(map(segment_vocalization_worker, sequences))
+        try:
+            yield from segment_batches_with(segment, batches, cache, report)
+        finally:
+            init_worker(means, kwargs)
+    else:
+        with multiprocessing.Pool(
+            workers, initializer=init_worker, initargs=(means, kwargs, instrument)
+        ) as pool:
+            segment = lambda sequences: pool.map(
+                segment_vocalization_worker, sequences, chunksize
+            )
+            yield from segment_batches_with(segment, batches, cache, report)
+
+
+def segment_batches_with(segment, batches, cache, report=None):
+    offset = 0
+    for sequences in batches:
+        if cache is None and report is None:
+            yield segment(sequences)
+        else:
+            best_paths = [None] * len(sequences)
+            if cache is not None:
+                best_paths = [cache.get(sequence) for sequence in sequences]
+            missing = [i for i, best_path in enumerate(best_paths) if best_path is None]
+            results = segment([sequences[i] for i in missing])
+            if report is not None:
+                report.add(
+                    [offset + i for i in missing],
+                    [sequences[i] for i in missing],
+                    [record for _, record in results],
+                )
+                results = [best_path for best_path, _ in results]
+            for i, best_path in zip(missing, results):
+                # best paths found within a search budget may not be optimal
+                if cache is not None and (len(best_path) == 2 or best_path[2]):
+                    cache.put(sequences[i], best_path[:2])
+                best_paths[i] = best_path
+            yield best_paths
+        offset += len(sequences)
 
-    new_rows = []
-    for i, ((path_tuples, score), sequence) in results.items():
+
+def segment_vocalizations(
+    sequences, means, workers=1, chunksize=16, cache=None, report=None, **kwargs
+):
+    return next(
+        segment_batches([sequences], means, workers, chunksize, cache, report, **kwargs)
+    )
+
+
+OUTPUT_COLUMNS = [
+    "REC",
+    "nClicks",
+    "Whale",
+    "TsTo",
+    "Vocalization",
+    "Coda",
+    "Duration",
+] + [f"ICI{i+1}" for i in range(9)]
+
+
+def get_sequences(dialogues):
+    icis = dialogues[[f"ICI{i+1}" for i in range(28)]].values
+    return [ici[ici > 0] for ici in icis]
+
+
+def get_coda_rows(dialogues, sequences, best_paths, vocalization_offset=0):
+    """One output row per segment of the best path of each vocalization in dialogues"""
+    rows, ts_offsets, codas, durations, icis = [], [], [], [], []
+    for i, ((path_tuples, *_), sequence) in enumerate(zip(best_paths, sequences)):
+        offsets = np.concatenate([[0.0], np.cumsum(sequence)])
         for id_, start, end in path_tuples:
             assert end <= len(sequence), f"{path_tuples = } - {sequence = }"
             delta = 9 - (end - start)
             assert (delta) >= 0, f"{path_tuples = } - {sequence = } - {delta = }"
-            buffer = [0.0] * max(0, delta)
-            tsToDelta = np.sum(sequence[:start])
-            new_row = (
-                list(dialogues.iloc[i, :][["REC", "nClicks", "Whale"]].values)
-                + [dialogues.iloc[i, :]["TsTo"] + tsToDelta]
-                + [i, id_, np.sum(sequence[start:end])]
-                + list(sequence[start:end])
-                + buffer
-            )
-            assert isinstance(new_row, list)
-            new_rows = new_rows + [new_row]
+            rows.append(i)
+            ts_offsets.append(offsets[start])
+            codas.append(UNKNOWN if id_ is None else int(id_))
+            durations.append(np.sum(sequence[start:end]))
+            icis.append(list(sequence[start:end]) + [0.0] * delta)
+    rows = np.array(rows, dtype=int)
     new_data = pd.DataFrame(
-        data=new_rows,
-        columns=["REC", "nClicks", "Whale", "TsTo", "Vocalization", "Coda", "Duration"]
-        + [f"ICI{i+1}" for i in range(9)],
+        {
+            "REC": dialogues["REC"].values[rows],
+            "nClicks": dialogues["nClicks"].values[rows],
+            "Whale": dialogues["Whale"].values[rows],
+            "TsTo": dialogues["TsTo"].values[rows] + np.array(ts_offsets, dtype=float),
+            "Vocalization": vocalization_offset + rows,
+            "Coda": codas,
+            "Duration": durations,
+        }
+    )
+    new_data[OUTPUT_COLUMNS[7:]] = np.array(icis, dtype=float).reshape(-1, 9)
+    return conform(new_data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["dp", "tree", "bnb"], default="dp")
+    parser.add_argument(
+        "--max-nodes",
+        type=int,
+        default=None,
+        help="nodes expanded per vocalization by the bnb engine before giving up",
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=None,
+        help="seconds spent per vocalization by the bnb engine before giving up",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunksize", type=int, default=16)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="number of vocalizations read, segmented and written at a time",
+    )
+    parser.add_argument("--cache", default=None, help="path of the segmentation cache")
+    parser.add_argument("--cache-max-entries", type=int, default=100000)
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="path of an extraction counters report, Prometheus text if it ends in .prom, JSON otherwise",
     )
+    parser.add_argument(
+        "--report-top",
+        type=int,
+        default=20,
+        help="number of slowest vocalizations reported",
+    )
+    parser.add_argument(
+        "--means-path",
+        default="data/coda-means.json",
+        help="coda means file, or a snapshot (directory) of 00_create_coda_means.py",
+    )
+    parser.add_argument(
+        "--templates",
+        default=ALL,
+        help="templates of a snapshot, e.g. Clan=EC1 or Unit=A, by default all codas",
+    )
+    parser.add_argument("--read-format", choices=FORMATS, default="csv")
+    parser.add_argument("--write-format", choices=FORMATS, default="csv")
+    args = parser.parse_args()
+
+    means = load_means(args.means_path, args.templates)
+    # the same bytes as data/coda-means.json, so cache keys stay the same
+    means_bytes = json.dumps({k: v.tolist() for k, v in means.items()}).encode()
+
+    params = {"limit": 100, "threshold": 0.1, "only_equal": True, "extra_value": 0.05}
+    cache = None
+    if args.cache is not None:
+        cache = SegmentationCache(
+            args.cache,
+            hashlib.sha256(means_bytes).hexdigest(),
+            max_entries=args.cache_max_entries,
+            **params,
+        )
+
+    report = None
+    if args.report is not None:
+        report = ExtractionReport(args.report_top)
+
+    chunks, chunks_ = itertools.tee(
+        read_table_chunks(
+            "data/sperm-whale-dialogues.csv",
+            args.read_format,
+            args.batch_size,
+            dtype=DTYPES,
+        )
+    )
+    batches = segment_batches(
+        (get_sequences(chunk) for chunk in chunks_),
+        means,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        cache=cache,
+        report=report,
+        engine=args.engine,
+        max_nodes=args.max_nodes,
+        max_seconds=args.max_seconds,
+        **params,
+    )
+
+    output_path = "data/sperm-whale-dialogues-codas-manhattan.csv"
+    vocalization_offset, not_optimal = 0, 0
+    with TableWriter(output_path, args.write_format) as writer:
+        for chunk, best_paths in zip(chunks, batches):
+            new_data = get_coda_rows(
+                chunk, get_sequences(chunk), best_paths, vocalization_offset
+            )
+            writer.write(new_data)
+            vocalization_offset += chunk.shape[0]
+            not_optimal += sum(len(p) > 2 and not p[2] for p in best_paths)
+    if args.engine == "bnb":
+        print(
+            f"{not_optimal} of {vocalization_offset} vocalizations were not proven "
+            "optimal within the search budget"
+        )
 
-    new_data["Coda"] = [int(v) if not pd.isnull(v) else -1 for v in new_data["Coda"]]
-    new_data.to_csv("data/sperm-whale-dialogues-codas-manhattan.csv", index=False)
+    if cache is not None:
+        cache.close()
+        print(f"{cache.stats() = }")
+
+    if report is not None:
+        report.write(args.report)
+        print(f"Slowest vocalizations, written to {args.report}:")
+        for record in report.slowest:
+            print(
+                f"{record['vocalization']:>8} {record['length']:>3} intervals "
+                f"{record['seconds']:.4f}s {record['tree_nodes'] + record['dp_nodes'] + record['bnb_nodes']} nodes "
+                f"{record['distances']} distances {record['max_backoff_depth']} back-off depth"
+            )
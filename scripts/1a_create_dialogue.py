@@ -1,13 +1,126 @@
+import argparse
+
 import numpy as np
 import pandas as pd
 
+from recordings import sort_by_recording
+from schema import DTYPES, ORNAMENTATION, SILENCE, UNKNOWN, VOCALIZATION_CHANGE, conform
+from tables import FORMATS, read_table, write_table
+
 THRESHOLD = 0.3
+CONTEXT = 10
 
-if __name__ == "__main__":
-    data = pd.read_csv("data/sperm-whale-dialogues-codas-manhattan.csv")
-    data["Start"] = data["TsTo"]
-    data["End"] = data["TsTo"].values + data["Duration"].values
+COLUMNS = [
+    "sequenceId",
+    "itemPosition",
+    "Coda1",
+    "Ornamentation1",
+    "Duration1",
+    "Coda2",
+    "Ornamentation2",
+    "Duration2",
+]
+CODA_COLUMNS = ["REC", "Whale", "TsTo", "Coda", "Duration"]
+
+
+def build_dialogues(data):
+    """Two whale dialogues computed column-wise in a single pass over the codas
+
+    For each whale of a recording, the codas of the recording are emitted once,
+    with the codas of that whale as primary; these copies are laid out with array
+    indexing rather than by rescanning the recording per whale.
+    """
+    data = sort_by_recording(data)
+    rec = data["REC"].values
+    coda = data["Coda"].values
+    has_previous = np.r_[False, rec[1:] == rec[:-1]]
+    has_next = np.r_[rec[:-1] == rec[1:], False]
+    ornamentation = (has_next & (np.r_[coda[1:], UNKNOWN] == ORNAMENTATION)).astype(int)
+    rec_id = np.cumsum(~has_previous) - 1
+
+    # one copy of the recording's codas per (recording, whale)
+    copies = (
+        pd.DataFrame({"rec": rec_id, "whale": data["Whale"].values})
+        .drop_duplicates()
+        .sort_values(["rec", "whale"])
+    )
+    copy_rec, copy_whale = copies["rec"].values, copies["whale"].values
+    kept = np.flatnonzero(~np.isin(coda, [ORNAMENTATION, UNKNOWN]))
+    n_kept = np.bincount(rec_id[kept], minlength=rec_id[-1] + 1 if len(rec) else 0)
+    kept_starts = np.cumsum(n_kept) - n_kept
+    lengths = n_kept[copy_rec]
+    copy_of_row = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    rows = kept[kept_starts[copy_rec[copy_of_row]] + offsets]
+
+    sequence_id = rec_id[rows]
+    ts_to = data["TsTo"].values[rows]
+    primary = data["Whale"].values[rows] == copy_whale[copy_of_row]
+    values = (coda[rows], ornamentation[rows], data["Duration"].values[rows])
+    none_values = (SILENCE, 0, 0.0)
+
+    # codas of different whales starting within THRESHOLD are merged into one row;
+    # like the sequential look-ahead, every other link of a chain of such codas is used
+    n = len(rows)
+    link = (
+        (primary[:-1] != primary[1:])
+        & (sequence_id[:-1] == sequence_id[1:])
+        & ((ts_to[1:] - ts_to[:-1]) < THRESHOLD)
+    )
+    link_index = np.arange(n - 1)
+    chain_start = np.maximum.accumulate(
+        np.where(link & ~np.r_[False, link[:-1]], link_index, 0)
+    )
+    paired = np.r_[link & ((link_index - chain_start) % 2 == 0), False][:n]
+    emitted = ~np.r_[False, paired[:-1]][:n]
+
+    index = np.arange(n)
+    partner = np.where(paired, index + 1, -1)
+    primary_index = np.where(primary, index, partner)[emitted]
+    secondary_index = np.where(primary, partner, index)[emitted]
 
+    def column(source, none_value, index):
+        return np.where(index >= 0, source[np.maximum(index, 0)], none_value)
+
+    # item positions restart after an unpaired row followed by another recording
+    new_sequence = np.r_[
+        True, ~paired[:-1] & emitted[:-1] & (sequence_id[1:] != sequence_id[:-1])
+    ][emitted]
+    position = np.arange(len(new_sequence))
+    item_position = position - np.maximum.accumulate(
+        np.where(new_sequence, position, 0)
+    )
+
+    dialogue = pd.DataFrame(
+        {
+            "sequenceId": sequence_id[emitted],
+            "itemPosition": item_position,
+            "Coda1": column(values[0], none_values[0], primary_index),
+            "Ornamentation1": column(values[1], none_values[1], primary_index),
+            "Duration1": column(values[2], none_values[2], primary_index),
+            "Coda2": column(values[0], none_values[0], secondary_index),
+            "Ornamentation2": column(values[1], none_values[1], secondary_index),
+            "Duration2": column(values[2], none_values[2], secondary_index),
+        }
+    )
+
+    # keep rows where the primary whale vocalizes, along with up to CONTEXT
+    # preceding rows of the same sequence
+    primary_vocalizes = dialogue["Coda1"].values != SILENCE
+    dialogue_sequence_id = dialogue["sequenceId"].values
+    selected = primary_vocalizes.copy()
+    for k in range(1, CONTEXT + 1):
+        selected[:-k] |= primary_vocalizes[k:] & (
+            dialogue_sequence_id[k:] == dialogue_sequence_id[:-k]
+        )
+    dialogue = dialogue[selected].reset_index(drop=True)
+    return conform(dialogue)
+
+
+def build_dialogues_iterrows(data):
+    """Row by row reference implementation of build_dialogues"""
     rec_counter = 0
     new_vals = []
     for rec, rec_data in data.groupby("REC"):
@@ -15,9 +128,11 @@ if __name__ == "__main__":
         whales = np.unique(rec_data["Whale"].values)
         for whale in whales:
             for i, row in rec_data.iterrows():
-                if row["Coda"] not in [100, -1]:
+                if row["Coda"] not in [ORNAMENTATION, UNKNOWN]:
                     if (i + 1) != rec_data.shape[0]:
-                        ornamentation = int(rec_data["Coda"].values[i + 1] == 100)
+                        ornamentation = int(
+                            rec_data["Coda"].values[i + 1] == ORNAMENTATION
+                        )
                     else:
                         ornamentation = int(False)
 
@@ -32,23 +147,6 @@ if __name__ == "__main__":
                     }
                     new_vals.append(vals)
 
-                    vocalization_change = (i != 0) and (
-                        rec_data["Vocalization"].values[i - 1] != row["Vocalization"]
-                    )
-                    if vocalization_change:
-                        start_moment = (
-                            rec_data[["TsTo", "Duration"]].values[i - 1, :].sum()
-                        )
-                        duration = max(0.0, row["TsTo"] - start_moment)
-                        change_vals = {
-                            "REC": rec_counter,
-                            "Coda": 99,
-                            "Ornamentation": 0,
-                            "Duration": duration,
-                            "TsTo": start_moment,
-                            "PrimaryWhale": primary_whale,
-                        }
-
         rec_counter += 1
 
     new_rows = []
@@ -57,7 +155,7 @@ if __name__ == "__main__":
     for i, vals in enumerate(new_vals):
         if not skip_next:
             vals2 = (vals["Coda"], vals["Ornamentation"], vals["Duration"])
-            none_vals = (98, 0, 0.0)
+            none_vals = (SILENCE, 0, 0.0)
 
             if (i + 1) != len(new_vals):
                 next_vals = new_vals[i + 1]
@@ -77,7 +175,7 @@ if __name__ == "__main__":
             else:
                 parallel_condition = False
 
-            if vals["Coda"] == 99:
+            if vals["Coda"] == VOCALIZATION_CHANGE:
                 new_row = (vals["REC"], item_position, *vals2, *vals2)
             elif vals["PrimaryWhale"] and not parallel_condition:
                 new_row = (vals["REC"], item_position, *vals2, *none_vals)
@@ -101,9 +199,8 @@ if __name__ == "__main__":
 
     new_rows_filtered = []
     i_in_rows_filtered = set()
-    print(f"{len(new_rows) = }")
     for i, row in enumerate(new_rows):
-        if row[2] != 98:
+        if row[2] != SILENCE:
             j_start = max(0, i - 10)
             for j, row2 in enumerate(new_rows[j_start:i]):
                 jj = j_start + j
@@ -113,19 +210,28 @@ if __name__ == "__main__":
 
             new_rows_filtered.append(row)
             i_in_rows_filtered.add(i)
-    print(f"{len(new_rows_filtered) = }")
 
-    dialogue = pd.DataFrame(
-        data=new_rows_filtered,
-        columns=[
-            "sequenceId",
-            "itemPosition",
-            "Coda1",
-            "Ornamentation1",
-            "Duration1",
-            "Coda2",
-            "Ornamentation2",
-            "Duration2",
-        ],
+    return conform(pd.DataFrame(data=new_rows_filtered, columns=COLUMNS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--engine", choices=["vectorized", "iterrows"], default="vectorized"
+    )
+    parser.add_argument("--read-format", choices=FORMATS, default="csv")
+    parser.add_argument("--write-format", choices=FORMATS, default="csv")
+    args = parser.parse_args()
+
+    data = read_table(
+        "data/sperm-whale-dialogues-codas-manhattan.csv",
+        args.read_format,
+        columns=CODA_COLUMNS,
+        dtype=DTYPES,
     )
-    dialogue.to_csv("data/whale-dialogues.csv", index=False)
+    if args.engine == "vectorized":
+        dialogue = build_dialogues(data)
+    else:
+        dialogue = build_dialogues_iterrows(data)
+    print(f"{len(dialogue) = }")
+    write_table(dialogue, "data/whale-dialogues.csv", args.write_format)
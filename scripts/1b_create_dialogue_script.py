@@ -1,13 +1,75 @@
+import argparse
+
 import pandas as pd
 import numpy as np
 
+from recordings import sort_by_recording
+from schema import DTYPES, ORNAMENTATION, UNKNOWN, conform
+from tables import FORMATS, read_table, write_table
+
 THRESHOLD = 0.3
 
-if __name__ == "__main__":
-    data = pd.read_csv("data/sperm-whale-dialogues-codas-manhattan.csv")
-    data["Start"] = data["TsTo"]
-    data["End"] = data["TsTo"].values + data["Duration"].values
+COLUMNS = [
+    "sequenceId",
+    "itemPosition",
+    "Whale",
+    "Coda",
+    "Ornamentation",
+    "Synchrony",
+    "Duration",
+    "TimeDelta",
+]
+CODA_COLUMNS = ["REC", "Whale", "TsTo", "Coda", "Duration"]
+
+
+def build_dialogue_script(data):
+    """Dialogue script computed column-wise on the codas sorted by REC and TsTo"""
+    data = sort_by_recording(data)
+    rec = data["REC"].values
+    ts_to = data["TsTo"].values
+    whale = data["Whale"].values
+    coda = data["Coda"].values
+
+    # neighbours within the same recording; the first/last row of a recording has none
+    has_previous = np.r_[False, rec[1:] == rec[:-1]]
+    has_next = np.r_[rec[:-1] == rec[1:], False]
+    previous_ts_to, next_ts_to = np.r_[np.nan, ts_to[:-1]], np.r_[ts_to[1:], np.nan]
+    previous_whale, next_whale = np.r_[-1, whale[:-1]], np.r_[whale[1:], -1]
+    next_coda = np.r_[coda[1:], UNKNOWN]
+
+    ornamentation = (has_next & (next_coda == ORNAMENTATION)).astype(int)
+    synchrony_backwards = (
+        has_previous
+        & ((ts_to - previous_ts_to) < THRESHOLD)
+        & (whale != previous_whale)
+    )
+    synchrony_forwards = (
+        has_next & ((ts_to - next_ts_to) < THRESHOLD) & (whale != next_whale)
+    )
+    synchrony = (synchrony_backwards | synchrony_forwards).astype(int)
+    sequence_id = np.cumsum(~has_previous) - 1
+
+    keep = ~np.isin(coda, [ORNAMENTATION, UNKNOWN])
+    dialogue = pd.DataFrame(
+        {
+            "sequenceId": sequence_id[keep],
+            "Whale": whale[keep],
+            "Coda": coda[keep],
+            "Ornamentation": ornamentation[keep],
+            "Synchrony": synchrony[keep],
+            "Duration": data["Duration"].values[keep],
+            "TsTo": ts_to[keep],
+        }
+    )
+    groups = dialogue.groupby("sequenceId", sort=False)
+    dialogue["itemPosition"] = groups.cumcount()
+    time_delta = (dialogue["TsTo"] - groups["TsTo"].shift(1)).fillna(0).values
+    dialogue["TimeDelta"] = np.log(0.1 + time_delta)
+    return conform(dialogue[COLUMNS])
+
 
+def build_dialogue_script_iterrows(data):
+    """Row by row reference implementation of build_dialogue_script"""
     rec_counter, item_position = 0, 0
     new_rows = []
     for rec, rec_data in data.groupby("REC"):
@@ -15,9 +77,9 @@ if __name__ == "__main__":
         previous_timestamp = None
         for i, row in rec_data.iterrows():
 
-            if row["Coda"] not in [100, -1]:                    
+            if row["Coda"] not in [ORNAMENTATION, UNKNOWN]:
                 if (i + 1) != rec_data.shape[0]:
-                    ornamentation = int(rec_data["Coda"].values[i + 1] == 100)
+                    ornamentation = int(rec_data["Coda"].values[i + 1] == ORNAMENTATION)
                 else:
                     ornamentation = int(False)
 
@@ -32,7 +94,11 @@ if __name__ == "__main__":
                     and (row["Whale"] != rec_data.iloc[i + 1, :]["Whale"])
                 )
                 synchrony = int(synchrony_backwards or synchrony_forwards)
-                time_delta = (0 if previous_timestamp is None else (row["TsTo"] - previous_timestamp))
+                time_delta = (
+                    0
+                    if previous_timestamp is None
+                    else (row["TsTo"] - previous_timestamp)
+                )
 
                 new_row = (
                     rec_counter,
@@ -50,17 +116,26 @@ if __name__ == "__main__":
         rec_counter += 1
         item_position = 0
 
-    dialogue = pd.DataFrame(
-        data=new_rows,
-        columns=[
-            "sequenceId",
-            "itemPosition",
-            "Whale",
-            "Coda",
-            "Ornamentation",
-            "Synchrony",
-            "Duration",
-            "TimeDelta",
-        ],
+    return conform(pd.DataFrame(data=new_rows, columns=COLUMNS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--engine", choices=["vectorized", "iterrows"], default="vectorized"
+    )
+    parser.add_argument("--read-format", choices=FORMATS, default="csv")
+    parser.add_argument("--write-format", choices=FORMATS, default="csv")
+    args = parser.parse_args()
+
+    data = read_table(
+        "data/sperm-whale-dialogues-codas-manhattan.csv",
+        args.read_format,
+        columns=CODA_COLUMNS,
+        dtype=DTYPES,
     )
-    dialogue.to_csv("data/whale-dialogue-script.csv", index=False)
+    if args.engine == "vectorized":
+        dialogue = build_dialogue_script(data)
+    else:
+        dialogue = build_dialogue_script_iterrows(data)
+    write_table(dialogue, "data/whale-dialogue-script.csv", args.write_format)
@@ -1,8 +1,13 @@
 # Written by Morgan Rivers!!
 import argparse
+import multiprocessing
+import os
 import pandas as pd
 import numpy as np
 
+from schema import DTYPES
+from tables import FORMATS, read_table_chunks
+
 """
 This python script generates a dialogue using the whale dialogue script data.
 It does so by first labeling the whale by its number ("Whale" column) and the words that it says.
@@ -13,83 +18,6 @@ timestamp and printing when codas are spoken effectively simultaneously.
 """
 THRESHOLD = 0.3
 SILENCE_THRESHOLD = 5.0
-# Reconstruct 'ConstructedString'
-def return_tempo(dur):
-    if dur < 0.45:
-        return 0
-    elif dur < 0.61:
-        return 1
-    elif dur < 0.93:
-        return 2
-    elif dur < 1.08:
-        return 3
-    else:
-        return 4
-
-def get_coda_string_representation(rhythm_index, tempo, ornamentation):
-    rhythm_char = chr(ord("a") + rhythm_index)
-    if ornamentation == 1:
-        rhythm_char = rhythm_char.upper()
-    else:
-        rhythm_char = rhythm_char.lower()
-
-    constructed_string = rhythm_char + str(tempo + 1)
-    return constructed_string
-
-# Function to determine rubato
-def determine_rubato(
-    word_string_previous, word_string, duration_previous, duration, t_diff
-):
-    if t_diff > 10:
-        return " "
-
-    # make sure the coda is one of the possibilities ('a' through 'r')
-    assert word_string[0].lower() in [chr(i) for i in range(ord('a'), ord('r') + 1)]
-    assert word_string_previous[0].lower() in [chr(i) for i in range(ord('a'), ord('r') + 1)]
-
-    rhythm_previous = word_string_previous.lower()[0]
-    rhythm = word_string.lower()[0]
-    tempo_previous = word_string_previous.lower()[1]
-    tempo = word_string.lower()[1]
-
-    # Rubato is defined as a change of duration within the same tempo and rhythm class
-    if rhythm_previous != rhythm:
-        return " "
-
-    if tempo_previous != tempo:
-        return " "
-
-    duration_delta = duration - duration_previous
-
-    return duration_delta
-
-
-# Function to categorize rubato
-def categorize_rubato(rubato):
-    quantile_25th = -0.02142
-    quantile_75th = 0.01846
-
-    # Assign categories based on these quantiles
-    if rubato < quantile_25th:
-        # Decreasing
-        return str("\\")
-    elif rubato < quantile_75th:
-        # Constant
-        return str("-")
-    else:
-        # Increasing
-        return str("/")
-
-
-
-# Function to print chorus
-def print_chorus(chorus_whales_data, f):
-    sorted_keys = sorted(chorus_whales_data)
-    sorted_texts = [
-        chorus_whales_data[key] for key in sorted_keys
-    ]  # Extract values in the sorted order of keys
-    chorus_string = f"In chorus, whales {', '.join(map(str, sorted_keys))}: {' '.join(sorted_texts)}."
-    f.write(chorus_string + "\n")
 
 
 # Function to print time without vocalizations
@@ -128,12 +56,15 @@ def format_time_no_vocalizations(time_diff):
 
 def group_annotation(annotation: list[dict]):
     annotation_groups = [[]]
+    whales_in_annotation_group = set()
     for i, annotat in enumerate(annotation):
-        whale_in_annotation_group = max(([False] + [annotat["whale_number"] == ann_gr["whale_number"] for ann_gr in annotation_groups[-1]]))
+        whale_in_annotation_group = annotat["whale_number"] in whales_in_annotation_group
         if i == 0 or annotat["time_delta"] > THRESHOLD or whale_in_annotation_group:
             annotation_groups.append([annotat])
+            whales_in_annotation_group = {annotat["whale_number"]}
         else:
             annotation_groups[-1].append(annotat)
+            whales_in_annotation_group.add(annotat["whale_number"])
     annotation_groups = [sorted(annotation_group, key=lambda x: x["whale_number"]) for annotation_group in annotation_groups]
     return(annotation_groups[1:])
 
@@ -153,101 +84,151 @@ def get_annotation_group_string(annotation_group):
         coda_string = ', '.join([annotation['text'] for annotation in annotation_group])
         return(f"{silence_string}{whales_string}: {coda_string}")
 
+TEMPO_BOUNDARIES = [0.45, 0.61, 0.93, 1.08]
+RUBATO_QUANTILES = [-0.02142, 0.01846]
+
+
+def get_coda_texts(sequence_id, coda, ornamentation, duration, time_delta):
+    """Text of each coda, computed column-wise
+
+    The text is the letter of the coda (upper case if ornamented) and its tempo
+    class by duration, after a rubato mark: within 10 seconds of the previous
+    coda of the sequence, with the same letter and tempo, the change of
+    duration is marked as decreasing, constant or increasing, by RUBATO_QUANTILES.
+    """
+    # boundaries in the dtype of the durations, so that a float32 duration falls
+    # on the same side of them as the decimal it was written as
+    tempo = np.searchsorted(
+        np.array(TEMPO_BOUNDARIES, dtype=duration.dtype), duration, side="right"
+    )
+    letters = np.array([chr(ord("a") + i) for i in range(26)])
+    rhythm_chars = np.where(
+        ornamentation == 1, np.char.upper(letters[coda]), letters[coda]
+    )
+    rhythm_letters = np.char.add(rhythm_chars, (tempo + 1).astype(str))
+
+    # rubato is the change of duration within the same tempo and rhythm class
+    is_first_in_sequence = np.r_[True, sequence_id[1:] != sequence_id[:-1]]
+    checked = ~is_first_in_sequence & (time_delta <= 10)
+    assert np.all((coda[checked] >= 0) & (coda[checked] < 18)), coda[checked]
+    has_rubato = (
+        checked
+        & (coda == np.r_[-1, coda[:-1]])
+        & (tempo == np.r_[-1, tempo[:-1]])
+    )
+    rubato = np.diff(duration, prepend=np.zeros(1, duration.dtype))
+    rubato_strings = np.where(
+        has_rubato,
+        np.array(["\\", "-", "/"])[
+            np.searchsorted(
+                np.array(RUBATO_QUANTILES, dtype=rubato.dtype), rubato, side="right"
+            )
+        ],
+        " ",
+    )
+    return np.char.add(rubato_strings, rhythm_letters)
+
+
+def render_sequence(sequence):
+    """Readable text of one sequence, given as (sequence_id, whales, texts, time_deltas)"""
+    sequence_id, whales, texts, time_deltas = sequence
+    annotation = [
+        {"whale_number": whale_number, "text": text, "time_delta": time_delta}
+        for whale_number, text, time_delta in zip(whales, texts, time_deltas)
+    ]
+    lines = [f"Sequence ID: {sequence_id}\n\n"]
+    for annotation_group in group_annotation(annotation):
+        lines.append(f"{get_annotation_group_string(annotation_group)}\n")
+    lines.append("\n\n")
+    return "".join(lines)
+
+
+def sequence_texts(rows, seen):
+    """(sequence_id, whales, texts, time_deltas) of each sequence in rows
+
+    seen holds the ids of the sequences yielded before, and is updated.
+    """
+    if len(rows) == 0:
+        return
+    sequence_ids = rows["sequenceId"].values
+    whales = rows["Whale"].values.astype(int).tolist()
+    time_deltas = np.exp(rows["TimeDelta"].values.astype(float)) - 0.1
+    texts = get_coda_texts(
+        sequence_ids,
+        rows["Coda"].values.astype(int),
+        rows["Ornamentation"].values.astype(int),
+        rows["Duration"].values,
+        time_deltas,
+    ).tolist()
+    time_deltas = time_deltas.tolist()
+
+    starts = np.flatnonzero(np.r_[True, sequence_ids[1:] != sequence_ids[:-1]])
+    for start, end in zip(starts.tolist(), starts[1:].tolist() + [len(rows)]):
+        sequence_id = sequence_ids[start]
+        if sequence_id in seen:
+            raise ValueError(
+                f"the rows of sequence {sequence_id} are not contiguous, sort the "
+                "table by sequenceId first, keeping the order of rows within each "
+                "sequence"
+            )
+        seen.add(sequence_id)
+        yield (
+            sequence_id,
+            whales[start:end],
+            texts[start:end],
+            time_deltas[start:end],
+        )
+
+
+def iter_sequences(path, chunksize=100000, format="csv"):
+    """Yields (sequence_id, whales, texts, time_deltas) for each sequence in path
+
+    The file is read in chunks of chunksize rows, and the texts of the sequences
+    a chunk completes are computed at once. The rows of each sequence must be
+    contiguous, as in the tables of 1b_create_dialogue_script.py and the
+    predictions of sequifier, otherwise a ValueError is raised.
+    """
+    seen = set()
+    # the rows read so far of the last sequence, which may continue
+    pending = []
+    for chunk in read_table_chunks(path, format, chunksize, dtype=DTYPES):
+        if len(chunk) == 0:
+            continue
+        sequence_ids = chunk["sequenceId"].values
+        if pending and np.all(sequence_ids == pending[0]["sequenceId"].values[0]):
+            pending.append(chunk)
+            continue
+        # the rows of a sequence are concatenated once, when it is complete
+        rows = pd.concat(pending + [chunk]) if pending else chunk
+        last_start = np.flatnonzero(
+            rows["sequenceId"].values != rows["sequenceId"].values[-1]
+        )
+        last_start = last_start[-1] + 1 if len(last_start) else 0
+        yield from sequence_texts(rows.iloc[:last_start], seen)
+        pending = [rows.iloc[last_start:]]
+
+    if pending:
+        yield from sequence_texts(pd.concat(pending), seen)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('path')
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows read at a time")
+    parser.add_argument("--read-format", choices=FORMATS, default="csv")
     args = vars(parser.parse_args())
 
-    # Load the data from the new data format
     path = args["path"]
-    data = pd.read_csv(path)
-
-    # Initialize all the different conversations as empty arrays
-    annotations = {sequence_id: [] for sequence_id in data["sequenceId"].unique()}
-    # Then we go over the entries of the annotation file one by one (row-wise) and append the annotation to the list corresponding to the sequence_id
-    prev_sequence_id = -np.inf
-    for i, row in data.iterrows():
-        sequence_id = row["sequenceId"]
-        time_delta = float(row["TimeDelta"]) 
-        if prev_sequence_id != sequence_id:
-            prev_rhythm_letter = None
-            is_first_in_sequence = True
-            prev_coda_duration = -np.inf
-        else:
-            # this is another coda in the sequence
-            is_first_in_sequence = False
-
-        whale_number = int(row["Whale"])
-        coda = int(row["Coda"]) 
-        ornamentation = int(row["Ornamentation"])
-        synchrony = int(row["Synchrony"])
-        duration = float(row["Duration"])
-
-        tempo = return_tempo(duration)
-
-        rhythm_letter = get_coda_string_representation(coda, tempo, ornamentation)
-
-        annotations[sequence_id].append(
-            {
-                "is_first_in_sequence": is_first_in_sequence,
-                "whale_number": whale_number,
-                "coda": coda,
-                "rhythm_letter": rhythm_letter,
-                "tempo": tempo,
-                "duration": duration,
-                "time_delta": np.exp(time_delta) - 0.1,
-                "synchrony": synchrony,
-                "prev_coda_duration": prev_coda_duration,
-                "prev_rhythm_letter": prev_rhythm_letter,
-            }
-        )
-
-        prev_sequence_id = sequence_id
-        prev_coda_duration = duration
-        prev_rhythm_letter = rhythm_letter
-
-
-    # CODA grouping parameters:
-    max_diff = 10  # Max time difference otherwise print that there was a pause
-    # Initialize an empty list to hold the dialogues
-    dialogues = []
-    rubato_deltas = []
-
-    # Compose the full text for the coda, including the rubato
-    for recording_id, recording in annotations.items():
-        for coda_position, this_coda in enumerate(recording):
-            if not this_coda["is_first_in_sequence"]:
-                rubato = determine_rubato(
-                    word_string_previous=this_coda["prev_rhythm_letter"],
-                    word_string=this_coda["rhythm_letter"],
-                    duration_previous=this_coda["prev_coda_duration"],
-                    duration=this_coda["duration"],
-                    t_diff=this_coda["time_delta"],
-                )
-                if rubato != " ":
-                    rubato_deltas.append(rubato)
-                    rubato_string = categorize_rubato(rubato)
-                else:
-                    rubato_string = " "
-            else:
-                rubato_string = " "
-            annotations[recording_id][coda_position]["text"] = rubato_string + this_coda["rhythm_letter"]
-
-    # Open the output file
-    with open(f"{path.replace('.csv', '-readable.txt')}", "w") as f:
-        # Print the dialogues
-        for sequence_id, annotation in annotations.items():
-
-            annotation_groups = group_annotation(annotation)
-
-            # Write filename right above the start of the conversation to the file
-            f.write(f"Sequence ID: {sequence_id}\n\n")
-
-            for annotation_group in annotation_groups:
-                annotation_group_string = get_annotation_group_string(annotation_group)
-                f.write(f"{annotation_group_string}\n")
-
-            f.write("\n\n")
-
+    sequences = iter_sequences(path, args["chunksize"], args["read_format"])
 
+    # Open the output file and write each conversation as soon as it is rendered
+    with open(f"{os.path.splitext(path)[0]}-readable.txt", "w") as f:
+        if args["workers"] <= 1:
+            for text in map(render_sequence, sequences):
+                f.write(text)
+        else:
+            with multiprocessing.Pool(args["workers"]) as pool:
+                for text in pool.imap(render_sequence, sequences, chunksize=16):
+                    f.write(text)
@@ -0,0 +1,276 @@
+import argparse
+import datetime
+import importlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+extract_codas = importlib.import_module("0_extract_codas")
+create_dialogue = importlib.import_module("1a_create_dialogue")
+create_dialogue_script = importlib.import_module("1b_create_dialogue_script")
+generate_readable_text = importlib.import_module("1c_generate_readable_text")
+
+# number of vocalizations in data/sperm-whale-dialogues.csv, i.e. scale 1
+BASE_VOCALIZATIONS = 3840
+RESULTS_PATH = "outputs/benchmarks/results.csv"
+RESULT_COLUMNS = ["timestamp", "commit", "benchmark", "parameter", "n", "seconds"]
+
+
+def generate_dialogues(n_vocalizations, means, seed=0):
+    """A synthetic table in the format of data/sperm-whale-dialogues.csv
+
+    Vocalizations consist of one to three codas drawn from the coda means, with
+    multiplicative noise on every inter click interval and an ornamentation
+    click after the last coda of about one in eight vocalizations. Recordings
+    hold one to four whales whose vocalizations are interleaved, a fifth of
+    them starting within 0.3 seconds of the previous one, so that codas of
+    different whales overlap.
+    """
+    rng = np.random.default_rng(seed)
+    codas = sorted(means, key=int)
+    relative_icis = np.zeros((len(codas), 9))
+    for i, coda in enumerate(codas):
+        positions = np.r_[0.0, means[coda]]
+        relative_icis[i, : len(means[coda])] = np.diff(positions)
+    lengths = np.array([len(means[coda]) for coda in codas])
+    weights = 1 / np.arange(1, len(codas) + 1)
+    weights = rng.permutation(weights / weights.sum())
+
+    # one row per coda, with the interval to the next click of the vocalization
+    n_codas = np.minimum(rng.geometric(0.7, n_vocalizations), 3)
+    vocalization = np.repeat(np.arange(n_vocalizations), n_codas)
+    n_units = len(vocalization)
+    types = rng.choice(len(codas), n_units, p=weights)
+    durations = rng.uniform(0.3, 1.4, n_units)
+    icis = relative_icis[types] * durations[:, None]
+    icis *= rng.lognormal(0.0, 0.05, icis.shape)
+    is_last = np.r_[vocalization[1:] != vocalization[:-1], True]
+    ornamented = is_last & (rng.random(n_units) < 0.13)
+    trailing = np.where(
+        is_last, rng.uniform(0.05, 0.4, n_units), rng.uniform(0.1, 0.3, n_units)
+    )
+    has_trailing = ~is_last | ornamented
+
+    # flatten the coda rows into up to 28 intervals per vocalization
+    unit_lengths = lengths[types]
+    width = np.arange(10)
+    mask = (width[None, :] < unit_lengths[:, None]) | (
+        (width[None, :] == unit_lengths[:, None]) & has_trailing[:, None]
+    )
+    values = np.concatenate([icis, np.zeros((n_units, 1))], axis=1)
+    values[np.arange(n_units), unit_lengths] = np.where(has_trailing, trailing, 0.0)
+    flat = values[mask]
+    flat_vocalization = np.repeat(vocalization, mask.sum(axis=1))
+    starts = np.searchsorted(flat_vocalization, np.arange(n_vocalizations))
+    position = np.arange(len(flat)) - starts[flat_vocalization]
+    keep = position < 28
+    ici_matrix = np.zeros((n_vocalizations, 28))
+    ici_matrix[flat_vocalization[keep], position[keep]] = flat[keep]
+    n_icis = (ici_matrix > 0).sum(axis=1)
+
+    # recordings with a mean of 17.5 vocalizations and one to four whales
+    recording_ends = np.cumsum(rng.geometric(1 / 17.5, n_vocalizations // 8 + 1))
+    recording = np.searchsorted(recording_ends, np.arange(n_vocalizations), "right")
+    n_whales = rng.choice([1, 2, 3, 4], n_vocalizations, p=[0.45, 0.4, 0.1, 0.05])
+    whale = (rng.random(n_vocalizations) * n_whales[recording]).astype(int) + 1
+    gaps = np.where(
+        rng.random(n_vocalizations) < 0.2,
+        rng.uniform(0.0, 0.3, n_vocalizations),
+        rng.exponential(3.5, n_vocalizations),
+    )
+    new_recording = np.r_[True, recording[1:] != recording[:-1]]
+    gaps[new_recording] = 0.0
+    elapsed = np.cumsum(gaps)
+    recording_start = elapsed[new_recording][np.cumsum(new_recording) - 1]
+    ts_to = 100.0 + recording * 10.0 + elapsed - recording_start
+
+    data = pd.DataFrame(
+        {
+            "REC": np.char.add("synthetic_", recording.astype(str)),
+            "nClicks": n_icis + 1,
+            "Duration": ici_matrix.sum(axis=1).round(7),
+        }
+    )
+    for i in range(28):
+        data[f"ICI{i+1}"] = ici_matrix[:, i].round(7)
+    data["Whale"] = whale
+    data["TsTo"] = ts_to.round(4)
+    return data
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_scale(scale, means, engines=("dp", "tree"), workers=1, seed=0):
+    """Seconds taken by each pipeline stage on synthetic data of a given scale"""
+    results = []
+    data, seconds = timed(generate_dialogues, BASE_VOCALIZATIONS * scale, means, seed)
+    results.append(("generate", f"scale={scale}", len(data), seconds))
+    sequences = extract_codas.get_sequences(data)
+
+    best_paths = None
+    for engine in engines:
+        paths, seconds = timed(
+            extract_codas.segment_vocalizations,
+            sequences,
+            means,
+            workers=workers,
+            engine=engine,
+            limit=100,
+            threshold=0.1,
+            only_equal=True,
+            extra_value=0.05,
+        )
+        results.append((f"extract-{engine}", f"scale={scale}", len(data), seconds))
+        best_paths = paths if best_paths is None else best_paths
+
+    codas = extract_codas.get_coda_rows(data, sequences, best_paths)
+    _, seconds = timed(create_dialogue.build_dialogues, codas)
+    results.append(("dialogues", f"scale={scale}", len(codas), seconds))
+    script, seconds = timed(create_dialogue_script.build_dialogue_script, codas)
+    results.append(("dialogue-script", f"scale={scale}", len(codas), seconds))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "whale-dialogue-script.csv")
+        script.to_csv(path, index=False)
+        start = time.perf_counter()
+        for sequence in generate_readable_text.iter_sequences(path):
+            generate_readable_text.render_sequence(sequence)
+        seconds = time.perf_counter() - start
+    results.append(("readable-text", f"scale={scale}", len(script), seconds))
+    return results
+
+
+def benchmark_lengths(means, engines=("dp", "tree"), per_length=20, seed=0):
+    """Mean seconds per vocalization of each engine, by number of intervals"""
+    data = generate_dialogues(BASE_VOCALIZATIONS, means, seed)
+    sequences = extract_codas.get_sequences(data)
+    by_length = {}
+    for sequence in sequences:
+        by_length.setdefault(len(sequence), []).append(sequence)
+    means_matrix = extract_codas.MeansMatrix(means)
+    coda_lengths = {k: len(v) for k, v in means.items()}
+
+    results = []
+    for length in sorted(by_length):
+        sample = by_length[length][:per_length]
+        for engine in engines:
+            start = time.perf_counter()
+            for sequence in sample:
+                extract_codas.segment_vocalization(
+                    sequence, means_matrix, coda_lengths, engine=engine
+                )
+            seconds = (time.perf_counter() - start) / len(sample)
+            results.append(
+                (
+                    f"extract-{engine}-per-vocalization",
+                    f"length={length}",
+                    len(sample),
+                    seconds,
+                )
+            )
+    return results
+
+
+def compare(results, previous, tolerance=0.2):
+    """Prints results next to the last stored run of each benchmark"""
+    last = {}
+    if previous is not None and len(previous):
+        last = previous.groupby(["benchmark", "parameter"])["seconds"].last().to_dict()
+    for benchmark, parameter, n, seconds in results:
+        before = last.get((benchmark, parameter))
+        line = f"{benchmark:<36}{parameter:<12}{n:>10}{seconds:>12.4f}s"
+        if before:
+            ratio = seconds / before
+            line += f"{ratio:>8.2f}x"
+            if ratio > 1 + tolerance:
+                line += "  slower than the last run"
+        print(line)
+
+
+def scaling_exponents(results):
+    """Slope of log(seconds) over log(scale) for each benchmark run at >1 scale"""
+    by_benchmark = {}
+    for benchmark, parameter, _, seconds in results:
+        if parameter.startswith("scale="):
+            scale = float(parameter.split("=")[1])
+            by_benchmark.setdefault(benchmark, []).append((scale, seconds))
+    return {
+        benchmark: float(np.polyfit(*np.log(np.array(points)).T, 1)[0])
+        for benchmark, points in by_benchmark.items()
+        if len(points) > 1 and all(s > 0 for _, s in points)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10, 100, 1000])
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["dp", "tree"],
+        default=["dp"],
+        help="extraction engines timed, e.g. --engines dp tree to compare them",
+    )
+    parser.add_argument(
+        "--max-tree-scale",
+        type=int,
+        default=10,
+        help="largest scale the tree engine is timed at, as it takes hours at "
+        "1000 times the corpus",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--per-length",
+        type=int,
+        default=20,
+        help="vocalizations of each length timed for the per vocalization benchmark",
+    )
+    parser.add_argument("--results-path", default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    with open("data/coda-means.json", "r") as f:
+        means = {k: np.array(v) for k, v in json.loads(f.read()).items()}
+
+    previous = None
+    if os.path.exists(args.results_path):
+        previous = pd.read_csv(args.results_path)
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    ).stdout.strip()
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+
+    results = benchmark_lengths(means, args.engines, args.per_length, args.seed)
+    compare(results, previous)
+    for scale in args.scales:
+        engines = [
+            engine
+            for engine in args.engines
+            if engine != "tree" or scale <= args.max_tree_scale
+        ]
+        if len(engines) == 0:
+            print(f"Skipping scale {scale}, above --max-tree-scale")
+            continue
+        scale_results = benchmark_scale(scale, means, engines, args.workers, args.seed)
+        compare(scale_results, previous)
+        results += scale_results
+    print(f"{scaling_exponents(results) = }")
+
+    os.makedirs(os.path.dirname(args.results_path), exist_ok=True)
+    pd.DataFrame(
+        [(timestamp, commit, *result) for result in results], columns=RESULT_COLUMNS
+    ).to_csv(
+        args.results_path,
+        index=False,
+        mode="a" if previous is not None else "w",
+        header=previous is None,
+    )
@@ -0,0 +1,194 @@
+import datetime
+import json
+import os
+import re
+
+import numpy as np
+
+ALL = "all"
+SNAPSHOT_DIRECTORY = "data/coda-means"
+
+
+class RunningMean:
+    """Count, mean and sum of squared deviations of click positions of a coda type
+
+    Batches are merged with the parallel form of Welford's algorithm, so adding
+    m codas costs O(m) whatever the number already seen. The first batch sets
+    the mean to its exact mean, so building from a single table gives the same
+    templates as averaging it at once.
+    """
+
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self, count=0, mean=None, m2=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, positions):
+        m = len(positions)
+        if m == 0:
+            return
+        batch_mean = positions.mean(axis=0)
+        batch_m2 = ((positions - batch_mean) ** 2).sum(axis=0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = m, batch_mean, batch_m2
+            return
+        if positions.shape[1] != len(self.mean):
+            raise ValueError(
+                f"codas with {positions.shape[1]} click positions can not update "
+                f"a template with {len(self.mean)}"
+            )
+        n = self.count + m
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * (m / n)
+        self.m2 = self.m2 + batch_m2 + delta**2 * (self.count * m / n)
+        self.count = n
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean.tolist(), "m2": self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["count"], np.array(d["mean"]), np.array(d["m2"]))
+
+
+class CodaMeansStore:
+    """Running coda templates, overall and per value of grouping columns
+
+    Templates are the mean positions of the clicks of a coda type relative to its
+    duration, without the first click at 0, as in data/coda-means.json. Besides
+    the overall templates ("all"), templates are kept per value of each grouping
+    column, e.g. "Clan=EC1" or "Unit=A". Snapshots are numbered JSON files in a
+    directory, each holding the full state, so any version can be loaded.
+    """
+
+    def __init__(self, group_columns=("Clan", "Unit")):
+        self.group_columns = list(group_columns)
+        self.templates = {}
+        self.sources = []
+        self.version = 0
+
+    def update(self, codas, positions, groups=None):
+        """Adds codas, an array of coda ids, with their click positions
+
+        positions maps each coda id to the rows of positions of its codas, in
+        the order they appear in codas. groups maps grouping columns to the
+        value of each coda.
+        """
+        groups = groups or {}
+        codas = np.asarray(codas)
+        labels = [(ALL, np.ones(len(codas), dtype=bool))]
+        for col in self.group_columns:
+            values = np.asarray(groups[col]).astype(str)
+            labels += [(f"{col}={v}", values == v) for v in np.unique(values)]
+        for coda, rows in positions.items():
+            is_coda = codas == coda
+            for label, mask in labels:
+                selected = rows[mask[is_coda]]
+                if len(selected):
+                    self.templates.setdefault(label, {}).setdefault(
+                        str(coda), RunningMean()
+                    ).update(selected)
+
+    def means(self, group=ALL, min_count=1):
+        """Templates of a group, as loaded by 0_extract_codas.py
+
+        Coda types with fewer than min_count codas in the group use the overall
+        template, so that every group has the same coda ids.
+        """
+        if group not in self.templates:
+            raise KeyError(f"no templates for {group}, available: {self.groups()}")
+        means = {
+            coda: running.mean[1:]
+            for coda, running in self.templates[ALL].items()
+            if running.count >= min_count
+        }
+        for coda, running in self.templates[group].items():
+            if running.count >= min_count:
+                means[coda] = running.mean[1:]
+        return dict(sorted(means.items(), key=lambda item: int(item[0])))
+
+    def groups(self):
+        return sorted(self.templates)
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "group_columns": self.group_columns,
+            "sources": self.sources,
+            "templates": {
+                group: {coda: running.to_dict() for coda, running in templates.items()}
+                for group, templates in self.templates.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        store = cls(d["group_columns"])
+        store.version = d["version"]
+        store.sources = d["sources"]
+        store.templates = {
+            group: {
+                coda: RunningMean.from_dict(running)
+                for coda, running in templates.items()
+            }
+            for group, templates in d["templates"].items()
+        }
+        return store
+
+    def save(self, directory=SNAPSHOT_DIRECTORY):
+        """Writes the next version of the store, and returns its path"""
+        os.makedirs(directory, exist_ok=True)
+        versions = snapshot_versions(directory)
+        self.version = max(versions + [self.version]) + 1
+        path = snapshot_path(directory, self.version)
+        with open(path, "w") as f:
+            f.write(json.dumps(self.to_dict()))
+        return path
+
+    @classmethod
+    def load(cls, directory=SNAPSHOT_DIRECTORY, version=None):
+        """The store of a snapshot, by default the latest"""
+        versions = snapshot_versions(directory)
+        if len(versions) == 0:
+            raise FileNotFoundError(f"no coda means snapshots in {directory}")
+        path = snapshot_path(directory, max(versions) if version is None else version)
+        with open(path, "r") as f:
+            return cls.from_dict(json.loads(f.read()))
+
+
+def snapshot_path(directory, version):
+    return os.path.join(directory, f"coda-means-v{version:05d}.json")
+
+
+def snapshot_versions(directory):
+    if not os.path.isdir(directory):
+        return []
+    return [
+        int(match.group(1))
+        for name in os.listdir(directory)
+        if (match := re.fullmatch(r"coda-means-v(\d+)\.json", name))
+    ]
+
+
+def load_means(path="data/coda-means.json", group=ALL, min_count=1):
+    """Coda templates from data/coda-means.json, a snapshot, or a snapshot directory
+
+    A directory loads its latest snapshot. group selects the templates of a
+    snapshot, and is ignored for a plain means file.
+    """
+    if os.path.isdir(path):
+        store = CodaMeansStore.load(path)
+    else:
+        with open(path, "r") as f:
+            content = json.loads(f.read())
+        if "templates" not in content:
+            return {k: np.array(v) for k, v in content.items()}
+        store = CodaMeansStore.from_dict(content)
+    return store.means(group, min_count)
@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from inference import DialogueModel, WindowBuffer
+
+
+class MicroBatcher:
+    """Coalesces the windows of concurrent generation steps into model runs
+
+    Windows are queued with run(), and each model run takes everything queued,
+    waiting up to max_wait seconds after the first window for more to arrive,
+    as long as the batch stays within max_batch_size sequences. Windows that
+    would exceed it wait for the next run, and run() splits requests of more
+    than max_batch_size sequences. Model runs happen one at a time on an
+    executor thread, so the event loop keeps accepting requests.
+    """
+
+    def __init__(self, model, max_batch_size=1024, max_wait=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        # the job taken from the queue that did not fit into the last batch
+        self.pending = None
+        self.batches, self.sequences = 0, 0
+
+    async def run(self, inputs):
+        """Model outputs for encoded windows, run together with other requests"""
+        n, m = self.size((inputs, None)), self.max_batch_size
+        if n > m:
+            parts = await asyncio.gather(
+                *(
+                    self.run({col: window[i : i + m] for col, window in inputs.items()})
+                    for i in range(0, n, m)
+                )
+            )
+            return {
+                col: np.concatenate([part[col] for part in parts]) for col in parts[0]
+            }
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((inputs, future))
+        return await future
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.pending is not None:
+                jobs, self.pending = [self.pending], None
+            else:
+                jobs = [await self.queue.get()]
+            n = self.size(jobs[0])
+            deadline = loop.time() + self.max_wait
+            while n < self.max_batch_size:
+                try:
+                    if self.queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        job = await asyncio.wait_for(self.queue.get(), timeout)
+                    else:
+                        job = self.queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if n + self.size(job) > self.max_batch_size:
+                    self.pending = job
+                    break
+                jobs.append(job)
+                n += self.size(job)
+
+            inputs = {
+                col: np.concatenate([job_inputs[col] for job_inputs, _ in jobs])
+                for col in jobs[0][0]
+            }
+            try:
+                outputs = await loop.run_in_executor(None, self.model.run, inputs)
+            except Exception as e:
+                for _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.sequences += n
+
+            start = 0
+            for job_inputs, future in jobs:
+                end = start + self.size((job_inputs, future))
+                if not future.done():
+                    future.set_result(
+                        {col: output[start:end] for col, output in outputs.items()}
+                    )
+                start = end
+
+    @staticmethod
+    def size(job):
+        return len(next(iter(job[0].values())))
+
+
+class GenerationService:
+    """Autoregressive generation for several clients from warm model sessions
+
+    Clients send one JSON request per line,
+
+        {"model": "sequifier-dialogue-script-best-5000",
+         "windows": {"Whale": [[...], ...], "Coda": [[...], ...],
+                     "Ornamentation": [[...], ...], "Synchrony": [[...], ...],
+                     "Duration": [[...], ...]},
+         "steps": 20, "sample_from_distribution_columns": ["Coda"], "seed": 1}
+
+    where windows hold the selected_columns of the model config as raw values,
+    one row per sequence, left padded if shorter than seq_length. Each
+    generated step is streamed back as soon as it is available, as
+    {"step": i, "values": {column: [value per sequence]}}, followed by
+    {"done": true, ...} with the request latencies, or by {"error": message}.
+    The request {"stats": true} returns the queue depth, batch sizes and
+    latency quantiles of each model.
+    """
+
+    def __init__(self, models, max_batch_size=1024, max_wait=0.005):
+        self.models = models
+        self.batchers = {
+            name: MicroBatcher(model, max_batch_size, max_wait)
+            for name, model in models.items()
+        }
+        self.latencies = {name: collections.deque(maxlen=1000) for name in models}
+        self.active = {name: 0 for name in models}
+
+    def encode_windows(self, model, windows):
+        encoded = {}
+        for col in model.categorical_columns + model.real_columns:
+            if col not in windows:
+                raise ValueError(f"missing input column {col}")
+            rows = [row[-model.seq_length :] for row in windows[col]]
+            window = np.zeros(
+                (len(rows), model.seq_length),
+                np.int64 if col in model.encoders else np.float32,
+            )
+            for i, row in enumerate(rows):
+                if len(row):
+                    window[i, model.seq_length - len(row) :] = model.encode(col, row)
+            encoded[col] = window
+        return encoded
+
+    async def generate(self, request):
+        """Yields the decoded values of each step of a generation request"""
+        name = request["model"]
+        if name not in self.models:
+            raise ValueError(f"unknown model {name}, available: {list(self.models)}")
+        model, batcher = self.models[name], self.batchers[name]
+        if set(model.categorical_columns + model.real_columns) != set(
+            model.target_columns
+        ):
+            raise ValueError(f"{name} does not predict all of its input columns")
+        sample_from_distribution_columns = (
+            request.get("sample_from_distribution_columns") or ()
+        )
+        rng = np.random.default_rng(request.get("seed"))
+
+        buffer = WindowBuffer(self.encode_windows(model, request["windows"]))
+        for _ in range(int(request["steps"])):
+            outputs = await batcher.run(buffer.window())
+            selected = model.select(outputs, sample_from_distribution_columns, rng)
+            buffer.push(selected)
+            yield {col: model.decode(col, values) for col, values in selected.items()}
+
+    def stats(self):
+        stats = {}
+        for name, batcher in self.batchers.items():
+            latencies = np.array(self.latencies[name])
+            stats[name] = {
+                "queue_depth": batcher.queue.qsize(),
+                "active_requests": self.active[name],
+                "batches": batcher.batches,
+                "mean_batch_size": (
+                    batcher.sequences / batcher.batches if batcher.batches else 0.0
+                ),
+                "requests": len(latencies),
+                "latency_p50": (
+                    float(np.quantile(latencies, 0.5)) if len(latencies) else None
+                ),
+                "latency_p95": (
+                    float(np.quantile(latencies, 0.95)) if len(latencies) else None
+                ),
+            }
+        return stats
+
+    async def handle(self, reader, writer):
+        async def send(message):
+            writer.write((json.dumps(message) + "\n").encode())
+            await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if request.get("stats"):
+                        await send(self.stats())
+                        continue
+                    await self.respond(request, send)
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    await send({"error": f"{type(e).__name__}: {e}"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, request, send):
+        name = request.get("model")
+        start = time.perf_counter()
+        first_step_latency, step = None, -1
+        if name in self.active:
+            self.active[name] += 1
+        try:
+            async for step, values in aenumerate(self.generate(request)):
+                if first_step_latency is None:
+                    first_step_latency = time.perf_counter() - start
+                await send(
+                    {
+                        "step": step,
+                        "values": {col: v.tolist() for col, v in values.items()},
+                    }
+                )
+        finally:
+            if name in self.active:
+                self.active[name] -= 1
+        latency = time.perf_counter() - start
+        self.latencies[name].append(latency)
+        await send(
+            {
+                "done": True,
+                "steps": step + 1,
+                "latency": latency,
+                "first_step_latency": first_step_latency,
+            }
+        )
+
+    async def serve(self, socket_path=None, host="127.0.0.1", port=8765):
+        batchers = [
+            asyncio.create_task(batcher.serve()) for batcher in self.batchers.values()
+        ]
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        print(f"Serving {list(self.models)} on {socket_path or f'{host}:{port}'}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for batcher in batchers:
+                batcher.cancel()
+
+
+async def aenumerate(iterable):
+    i = 0
+    async for item in iterable:
+        yield i, item
+        i += 1
+
+
+def load_model(config_path, threads=None):
+    import yaml
+
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+    model = DialogueModel(
+        config["model_path"],
+        config["ddconfig_path"],
+        config["selected_columns"],
+        config["target_columns"],
+        seq_length=config["seq_length"],
+        threads=threads,
+    )
+    return os.path.split(config["model_path"])[1].replace(".onnx", ""), model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config-paths",
+        nargs="+",
+        default=[
+            "configs/infer.yaml",
+            "configs/infer-dialogue-script-best-5000.yaml",
+        ],
+        help="inference configs of the models to serve, named by their model file; "
+        "models that fail to load are skipped",
+    )
+    parser.add_argument("--socket", default=None, help="serve on this unix socket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=1024)
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default=0.005,
+        help="seconds to wait for more requests before running a batch",
+    )
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    models = {}
+    for path in args.config_paths:
+        try:
+            name, model = load_model(path, args.threads)
+        except Exception as e:
+            print(
+                f"Skipping {path}, its model failed to load: {type(e).__name__}: {e}",
+                file=sys.stderr,
+            )
+            continue
+        models[name] = model
+    if not models:
+        sys.exit("No model could be loaded")
+    service = GenerationService(models, args.max_batch_size, args.max_wait)
+    asyncio.run(service.serve(args.socket, args.host, args.port))
@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class DialogueModel:
+    """CPU inference for the dialogue models exported by sequifier
+
+    Categorical values are mapped to and from model ids with the id_maps of the
+    ddconfig, and real values are normalized with its min_max_values, using array
+    lookups only. Windows of many sequences are packed into batches of the
+    model's batch size (exported graphs have a fixed batch size, equal to
+    inference_batch_size in the training config, unless the batch dimension is
+    dynamic), and batches are run concurrently on a thread pool.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        ddconfig_path,
+        selected_columns,
+        target_columns,
+        seq_length=25,
+        max_batch_size=1024,
+        threads=None,
+    ):
+        import onnxruntime
+
+        with open(ddconfig_path, "r") as f:
+            ddconfig = json.loads(f.read())
+
+        self.seq_length = seq_length
+        self.threads = threads or os.cpu_count()
+        self.target_columns = target_columns
+        column_types = ddconfig["column_types"]
+        self.categorical_columns = [
+            col for col in selected_columns if column_types[col] == "int64"
+        ]
+        self.real_columns = [
+            col for col in selected_columns if column_types[col] != "int64"
+        ]
+        self.min_max_values = ddconfig["min_max_values"]
+
+        # value -> id and id -> value lookup arrays; unknown values map to id 0,
+        # which maps back to -1
+        self.encoders, self.decoders = {}, {}
+        for col in self.categorical_columns:
+            values = np.array([int(v) for v in ddconfig["id_maps"][col].keys()])
+            ids = np.array(list(ddconfig["id_maps"][col].values()))
+            self.encoders[col] = np.zeros(values.max() + 1, dtype=np.int64)
+            self.encoders[col][values] = ids
+            self.decoders[col] = np.full(ids.max() + 1, -1, dtype=np.int64)
+            self.decoders[col][ids] = values
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1 if self.threads > 1 else 0
+        self.session = onnxruntime.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [input_.name for input_ in self.session.get_inputs()]
+        n_outputs = len(self.session.get_outputs())
+        if len(self.input_names) != len(selected_columns) or n_outputs != len(
+            target_columns
+        ):
+            raise ValueError(
+                f"{model_path} has {len(self.input_names)} inputs and {n_outputs} outputs, "
+                f"but {selected_columns = } and {target_columns = }"
+            )
+        fixed_batch_sizes = [
+            input_.shape[0]
+            for input_ in self.session.get_inputs()
+            if isinstance(input_.shape[0], int)
+        ]
+        self.batch_size = (
+            max(fixed_batch_sizes) if len(fixed_batch_sizes) else max_batch_size
+        )
+        self.fixed_batch_size = len(fixed_batch_sizes) > 0
+
+    def encode(self, col, values):
+        """Model inputs for raw values of a column"""
+        values = np.asarray(values)
+        if col in self.encoders:
+            encoder = self.encoders[col]
+            values = values.astype(np.int64)
+            known = (values >= 0) & (values < len(encoder))
+            return np.where(known, encoder[np.where(known, values, 0)], 0)
+        min_ = self.min_max_values[col]["min"]
+        max_ = self.min_max_values[col]["max"]
+        return ((((values - min_) / (max_ - min_)) * 1.6) - 0.8).astype(np.float32)
+
+    def decode(self, col, values):
+        """Raw values for model ids or normalized values of a column"""
+        if col in self.decoders:
+            decoder = self.decoders[col]
+            return np.where(
+                values < len(decoder), decoder[np.minimum(values, len(decoder) - 1)], -1
+            )
+        min_ = self.min_max_values[col]["min"]
+        max_ = self.min_max_values[col]["max"]
+        return (((values + 0.8) / 1.6) * (max_ - min_)) + min_
+
+    def run(self, inputs):
+        """Model outputs for encoded windows {column: (n, seq_length)}
+
+        Returns log probabilities (n, n_classes) for categorical target columns
+        and normalized values (n,) for real target columns.
+        """
+        n = len(inputs[self.categorical_columns[0]])
+        starts = list(range(0, n, self.batch_size))
+
+        def run_batch(start):
+            feed = {}
+            for name, col in zip(
+                self.input_names, self.categorical_columns + self.real_columns
+            ):
+                batch = inputs[col][start : start + self.batch_size]
+                if self.fixed_batch_size and len(batch) < self.batch_size:
+                    padding = np.zeros(
+                        (self.batch_size - len(batch), batch.shape[1]), batch.dtype
+                    )
+                    batch = np.concatenate([batch, padding], axis=0)
+                feed[name] = batch
+            return self.session.run(None, feed)
+
+        if self.threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(self.threads) as executor:
+                batches = list(executor.map(run_batch, starts))
+        else:
+            batches = [run_batch(start) for start in starts]
+
+        outputs = {}
+        for i, col in enumerate(self.target_columns):
+            output = np.concatenate([batch[i] for batch in batches], axis=0)[:n]
+            outputs[col] = output if col in self.decoders else output[:, 0]
+        return outputs
+
+    def select(self, outputs, sample_from_distribution_columns=(), rng=None):
+        """Encoded next values from model outputs, sampled or most likely"""
+        rng = np.random.default_rng() if rng is None else rng
+        selected = {}
+        for col, output in outputs.items():
+            if col not in self.decoders:
+                selected[col] = output
+            elif col in sample_from_distribution_columns:
+                cumulative_probs = np.cumsum(np.exp(output), axis=1)
+                threshold = rng.random((output.shape[0], 1))
+                selected[col] = (threshold < cumulative_probs).argmax(axis=1)
+            else:
+                selected[col] = output.argmax(axis=1)
+        return selected
+
+    def predict(self, inputs, sample_from_distribution_columns=(), rng=None):
+        """Decoded next values for encoded windows, sampled or most likely"""
+        selected = self.select(self.run(inputs), sample_from_distribution_columns, rng)
+        return {col: self.decode(col, values) for col, values in selected.items()}
+
+
+class WindowBuffer:
+    """The last seq_length encoded values of each column, for many sequences
+
+    Each column is a preallocated ring buffer of width 2 * seq_length in which
+    every value is written twice, seq_length apart, so that the current window
+    is always a contiguous slice that can be handed to the model without copying.
+    """
+
+    def __init__(self, windows):
+        self.seq_length = next(iter(windows.values())).shape[1]
+        self.buffers = {
+            col: np.concatenate([window, window], axis=1)
+            for col, window in windows.items()
+        }
+        self.position = 0
+
+    def window(self):
+        return {
+            col: buffer[:, self.position : self.position + self.seq_length]
+            for col, buffer in self.buffers.items()
+        }
+
+    def push(self, values):
+        """Appends one value per sequence to each column, dropping the oldest"""
+        for col, buffer in self.buffers.items():
+            buffer[:, self.position] = values[col]
+            buffer[:, self.position + self.seq_length] = values[col]
+        self.position = (self.position + 1) % self.seq_length
+
+
+def generate(model, windows, steps, sample_from_distribution_columns=(), rng=None):
+    """Yields the decoded values of each autoregressive step after windows
+
+    The model state is a WindowBuffer, so memory does not grow with steps.
+    Predictions are fed back encoded, i.e. as ids and normalized values.
+    """
+    input_columns = model.categorical_columns + model.real_columns
+    assert set(input_columns) == set(model.target_columns), (
+        "autoregression requires the target columns to be the input columns",
+        input_columns,
+        model.target_columns,
+    )
+    buffer = WindowBuffer(windows)
+    for _ in range(steps):
+        selected = model.select(
+            model.run(buffer.window()), sample_from_distribution_columns, rng
+        )
+        buffer.push(selected)
+        yield {col: model.decode(col, values) for col, values in selected.items()}
+
+
+def read_windows(path, columns, seq_length):
+    """Encoded input windows and sequence ids from a sequifier split file"""
+    import pandas as pd
+
+    data = pd.read_csv(path)
+    window_columns = [str(c) for c in range(seq_length, 0, -1)]
+    input_cols = data["inputCol"].values
+    windows = {
+        col: data.loc[input_cols == col, window_columns].values for col in columns
+    }
+    sequence_ids = data.loc[input_cols == columns[0], "sequenceId"].values
+    return sequence_ids, windows
+
+
+def get_last_windows(sequence_ids, windows):
+    """The last window of each sequence, for windows in sequence order"""
+    last = np.r_[sequence_ids[1:] != sequence_ids[:-1], True]
+    return sequence_ids[last], {col: window[last] for col, window in windows.items()}
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    import yaml
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config-path", default="configs/infer.yaml")
+    parser.add_argument("--model-path", default=None)
+    parser.add_argument("--data-path", default=None)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=1024,
+        help="number of sequences generated at a time with autoregression",
+    )
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    model_path = args.model_path or config["model_path"]
+    data_path = args.data_path or config["data_path"]
+
+    model = DialogueModel(
+        model_path,
+        config["ddconfig_path"],
+        config["selected_columns"],
+        config["target_columns"],
+        seq_length=config["seq_length"],
+        threads=args.threads,
+    )
+    sequence_ids, windows = read_windows(
+        data_path,
+        model.categorical_columns + model.real_columns,
+        config["seq_length"],
+    )
+    windows = {
+        col: window.astype(np.int64 if col in model.encoders else np.float32)
+        for col, window in windows.items()
+    }
+    rng = np.random.default_rng(args.seed)
+    sample_from_distribution_columns = (
+        config.get("sample_from_distribution_columns") or ()
+    )
+    model_id = os.path.split(model_path)[1].replace(".onnx", "")
+    os.makedirs("outputs/predictions", exist_ok=True)
+    predictions_path = f"outputs/predictions/{model_id}-predictions.csv"
+    print(f"Writing predictions to {predictions_path}")
+
+    if not config.get("autoregression"):
+        predictions = model.predict(windows, sample_from_distribution_columns, rng)
+        pd.DataFrame({"sequenceId": sequence_ids, **predictions}).to_csv(
+            predictions_path, index=False
+        )
+    else:
+        # sequences are generated in blocks, so that only block_size * steps
+        # generated values are held before they are written in sequence order
+        steps = config["autoregression_additional_steps"]
+        sequence_ids, windows = get_last_windows(sequence_ids, windows)
+        for start in range(0, len(sequence_ids), args.block_size):
+            block = slice(start, start + args.block_size)
+            n = len(sequence_ids[block])
+            generated = {
+                col: np.empty((n, steps), np.int64 if col in model.decoders else float)
+                for col in model.target_columns
+            }
+            for step, values in enumerate(
+                generate(
+                    model,
+                    {col: window[block] for col, window in windows.items()},
+                    steps,
+                    sample_from_distribution_columns,
+                    rng,
+                )
+            ):
+                for col, generated_col in generated.items():
+                    generated_col[:, step] = values[col]
+            pd.DataFrame(
+                {
+                    "sequenceId": np.repeat(sequence_ids[block], steps),
+                    **{col: values.ravel() for col, values in generated.items()},
+                }
+            ).to_csv(
+                predictions_path,
+                index=False,
+                mode="w" if start == 0 else "a",
+                header=start == 0,
+            )
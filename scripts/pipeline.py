@@ -0,0 +1,250 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from coda_means import SNAPSHOT_DIRECTORY
+from tables import FORMATS, table_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_PATH = "data/.pipeline-state.json"
+
+
+class Stage:
+    """A script of the pipeline, with the files it reads and writes
+
+    sources are the python files the stage's results depend on, so constants
+    such as THRESHOLD in 1a and 1b are part of the stage key. args are passed
+    to the script and are part of the key, options are passed but are not,
+    as they do not change the outputs.
+    """
+
+    def __init__(self, name, sources, inputs, outputs, args=(), options=()):
+        self.name = name
+        self.sources = sources
+        self.inputs = inputs
+        self.outputs = outputs
+        self.args = list(args)
+        self.options = list(options)
+
+    def command(self):
+        return [sys.executable, self.sources[0]] + self.args + self.options
+
+
+def get_stages(format="csv", workers=1):
+    def table(path):
+        return table_path(path, format)
+
+    formats = ["--read-format", format, "--write-format", format]
+    stages = []
+    source = "data/sperm-whale-dialogues.csv"
+    if format != "csv":
+        stages.append(
+            Stage(
+                "convert-dialogues",
+                ["scripts/tables.py"],
+                [source],
+                [table(source)],
+                [source, "--write-format", format],
+            )
+        )
+    stages += [
+        Stage(
+            "coda-means",
+            [
+                "scripts/00_create_coda_means.py",
+                "scripts/coda_means.py",
+            ],
+            ["data/DominicaCodas.csv"],
+            # every run writes the next snapshot of the running means
+            ["data/coda-means.json", SNAPSHOT_DIRECTORY],
+            ["--snapshot-directory", SNAPSHOT_DIRECTORY],
+        ),
+        Stage(
+            "extract-codas",
+            [
+                "scripts/0_extract_codas.py",
+                "scripts/coda_means.py",
+                "scripts/schema.py",
+                "scripts/segmentation_cache.py",
+                "scripts/tables.py",
+            ],
+            ["data/coda-means.json", table(source)],
+            [table("data/sperm-whale-dialogues-codas-manhattan.csv")],
+            formats,
+            ["--workers", str(workers)],
+        ),
+        Stage(
+            "dialogues",
+            [
+                "scripts/1a_create_dialogue.py",
+                "scripts/recordings.py",
+                "scripts/schema.py",
+                "scripts/tables.py",
+            ],
+            [table("data/sperm-whale-dialogues-codas-manhattan.csv")],
+            [table("data/whale-dialogues.csv")],
+            formats,
+        ),
+        Stage(
+            "dialogue-script",
+            [
+                "scripts/1b_create_dialogue_script.py",
+                "scripts/recordings.py",
+                "scripts/schema.py",
+                "scripts/tables.py",
+            ],
+            [table("data/sperm-whale-dialogues-codas-manhattan.csv")],
+            [table("data/whale-dialogue-script.csv")],
+            formats,
+        ),
+        Stage(
+            "readable-text",
+            [
+                "scripts/1c_generate_readable_text.py",
+                "scripts/schema.py",
+                "scripts/tables.py",
+            ],
+            [table("data/whale-dialogue-script.csv")],
+            ["data/whale-dialogue-script-readable.txt"],
+            [table("data/whale-dialogue-script.csv"), "--read-format", format],
+            ["--workers", str(workers)],
+        ),
+    ]
+    return stages
+
+
+def hash_path(path):
+    """Hash of the contents of a file, or of all files in a directory"""
+    hash_ = hashlib.sha256()
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    for file_path in paths:
+        hash_.update(os.path.basename(file_path).encode() + b"\0")
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hash_.update(block)
+    return hash_.hexdigest()
+
+
+def stage_key(stage, hashes):
+    """Hash of everything that determines the outputs of a stage"""
+    key = {
+        "sources": {path: hash_path(path) for path in stage.sources},
+        "args": stage.args,
+        "inputs": {path: hashes.get(path) or hash_path(path) for path in stage.inputs},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def is_up_to_date(stage, key, state):
+    entry = state.get(stage.name)
+    if entry is None or entry["key"] != key:
+        return False
+    # outputs that were removed or edited since the stage ran are recreated
+    return all(
+        os.path.exists(path) and hash_path(path) == entry["outputs"].get(path)
+        for path in stage.outputs
+    )
+
+
+def run_pipeline(stages, state, force=(), dry_run=False, jobs=2):
+    """Runs the stages that are not up to date, independent stages in parallel
+
+    A stage is run once all stages writing its inputs have finished. It is
+    skipped if its key, and the hashes of its outputs, match the last run, so
+    a stage whose inputs were rewritten with identical contents is skipped too.
+    """
+    producers = {path: stage.name for stage in stages for path in stage.outputs}
+    dependencies = {
+        stage.name: {producers[path] for path in stage.inputs if path in producers}
+        for stage in stages
+    }
+    hashes, done, running = {}, set(), {}
+    pending = list(stages)
+
+    def finish(stage, key):
+        for path in stage.outputs:
+            hashes[path] = hash_path(path)
+        state[stage.name] = {
+            "key": key,
+            "outputs": {path: hashes[path] for path in stage.outputs},
+        }
+        done.add(stage.name)
+
+    with ThreadPoolExecutor(jobs) as executor:
+        while pending or running:
+            for stage in [s for s in pending if dependencies[s.name] <= done]:
+                pending.remove(stage)
+                key = stage_key(stage, hashes)
+                if stage.name not in force and is_up_to_date(stage, key, state):
+                    print(f"{stage.name}: up to date")
+                    hashes.update(state[stage.name]["outputs"])
+                    done.add(stage.name)
+                elif dry_run:
+                    print(f"{stage.name}: would run {' '.join(stage.command())}")
+                    hashes.update({path: "pending" for path in stage.outputs})
+                    done.add(stage.name)
+                else:
+                    print(f"{stage.name}: running {' '.join(stage.command())}")
+                    future = executor.submit(
+                        subprocess.run,
+                        stage.command(),
+                        capture_output=True,
+                        text=True,
+                    )
+                    running[future] = (stage, key, time.perf_counter())
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key, start = running.pop(future)
+                result = future.result()
+                sys.stdout.write(result.stdout)
+                if result.returncode != 0:
+                    sys.stderr.write(result.stderr)
+                    raise RuntimeError(
+                        f"{stage.name} failed with exit code {result.returncode}"
+                    )
+                finish(stage, key)
+                print(f"{stage.name}: done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs the data pipeline, skipping stages that are up to date"
+    )
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--jobs", type=int, default=2, help="number of stages run at the same time"
+    )
+    parser.add_argument(
+        "--force", nargs="*", default=[], help="stages run even if up to date"
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    state = {}
+    if os.path.exists(STATE_PATH):
+        with open(STATE_PATH, "r") as f:
+            state = json.loads(f.read())
+    try:
+        run_pipeline(
+            get_stages(args.format, args.workers),
+            state,
+            force=args.force,
+            dry_run=args.dry_run,
+            jobs=args.jobs,
+        )
+    finally:
+        if not args.dry_run:
+            with open(STATE_PATH, "w") as f:
+                f.write(json.dumps(state, indent=2))
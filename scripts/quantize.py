@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from inference import DialogueModel
+from windows import WindowDataset
+
+VARIANTS = ["float", "int8-dynamic", "int8-static"]
+REPORT_PATH = "outputs/quantization/report.csv"
+
+
+def variant_path(model_path, variant):
+    return model_path.replace(".onnx", f"-{variant}.onnx")
+
+
+def model_inputs(model, inputs):
+    """Encoded dataset windows as the dtypes the model takes"""
+    return {
+        col: inputs[col].astype(np.int64 if col in model.encoders else np.float32)
+        for col in model.categorical_columns + model.real_columns
+    }
+
+
+class WindowReader:
+    """Calibration windows for onnxruntime static quantization, one at a time
+
+    The exported graphs have a batch size of 1, so every window is one feed.
+    """
+
+    def __init__(self, model, inputs):
+        self.feeds = iter(
+            {
+                name: inputs[col][i : i + 1]
+                for name, col in zip(
+                    model.input_names, model.categorical_columns + model.real_columns
+                )
+            }
+            for i in range(len(inputs[model.categorical_columns[0]]))
+        )
+
+    def get_next(self):
+        return next(self.feeds, None)
+
+
+def quantize(model, model_path, variant, calibration_inputs=None):
+    """Writes an int8 variant of a model next to it, and returns its path
+
+    Only MatMul and Gemm are quantized, which hold nearly all weights. The layer
+    normalisations, computed from ReduceMean, Pow and Sqrt, stay in float, as
+    their small ranges lose most of their precision in int8.
+    """
+    from onnxruntime.quantization import (
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    output_path = variant_path(model_path, variant)
+    with tempfile.TemporaryDirectory() as directory:
+        preprocessed_path = os.path.join(directory, "preprocessed.onnx")
+        quant_pre_process(model_path, preprocessed_path, skip_symbolic_shape=True)
+        if variant == "int8-dynamic":
+            quantize_dynamic(
+                preprocessed_path,
+                output_path,
+                op_types_to_quantize=["MatMul", "Gemm"],
+                weight_type=QuantType.QInt8,
+            )
+        elif variant == "int8-static":
+            quantize_static(
+                preprocessed_path,
+                output_path,
+                WindowReader(model, calibration_inputs),
+                quant_format=QuantFormat.QDQ,
+                op_types_to_quantize=["MatMul", "Gemm"],
+                activation_type=QuantType.QInt8,
+                weight_type=QuantType.QInt8,
+                calibrate_method=CalibrationMethod.MinMax,
+            )
+        else:
+            raise ValueError(f"unknown variant {variant}, expected one of {VARIANTS}")
+    return output_path
+
+
+def evaluate(model, inputs, targets, reference=None):
+    """Accuracy of categorical and L1 error of real next values
+
+    Accuracy is against the targets of the windows, agreement and L1 error
+    against the outputs of a reference (float) model, if given.
+    """
+    outputs = model.run(inputs)
+    selected = model.select(outputs)
+    metrics = {}
+    for col in model.target_columns:
+        if col in model.decoders:
+            metrics[f"{col}_accuracy"] = float(np.mean(selected[col] == targets[col]))
+        if reference is None:
+            continue
+        if col in model.decoders:
+            metrics[f"{col}_agreement"] = float(
+                np.mean(selected[col] == reference[col])
+            )
+        else:
+            metrics[f"{col}_l1"] = float(
+                np.mean(
+                    np.abs(
+                        model.decode(col, selected[col])
+                        - model.decode(col, reference[col])
+                    )
+                )
+            )
+    return metrics, selected
+
+
+def time_steps(model, inputs, batch_size, repeats=5):
+    """Median seconds of one generation step for batch_size sequences"""
+    n = len(inputs[model.categorical_columns[0]])
+    indices = np.arange(batch_size) % n
+    batch = {col: values[indices] for col, values in inputs.items()}
+    model.run(batch)
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.run(batch)
+        seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds))
+
+
+def load_dataset(model, ddconfig_path, data_path, seq_length):
+    """Windows of the table a ddconfig was made from, checked against its encoding"""
+    with open(ddconfig_path, "r") as f:
+        ddconfig = json.loads(f.read())
+    columns = model.categorical_columns + model.real_columns
+    dataset = WindowDataset.from_table(data_path, columns, seq_length)
+    dataset.check_encoding(ddconfig)
+    return dataset
+
+
+def report_model(config, args, rng):
+    model_path = config["model_path"]
+    float_model = DialogueModel(
+        model_path,
+        config["ddconfig_path"],
+        config["selected_columns"],
+        config["target_columns"],
+        seq_length=config["seq_length"],
+        threads=args.threads,
+    )
+    data_path = args.data_path or os.path.join(
+        "data", os.path.basename(config["ddconfig_path"]).replace(".json", ".csv")
+    )
+    dataset = load_dataset(
+        float_model, config["ddconfig_path"], data_path, config["seq_length"]
+    )
+    train, _, test = dataset.split([0.8, 0.1, 0.1])
+
+    calibration = rng.choice(
+        len(train), min(args.calibration_windows, len(train)), replace=False
+    )
+    calibration_inputs = model_inputs(float_model, train.batch(calibration)[0])
+    test_inputs, test_targets = test.batch(np.arange(len(test)))
+    test_inputs = model_inputs(float_model, test_inputs)
+    test_targets = {col: values[:, -1] for col, values in test_targets.items()}
+
+    # the float model comes first, as the reference of the others
+    variants = ["float"] + [v for v in args.variants if v != "float"]
+    rows, reference = [], None
+    for variant in variants:
+        path = model_path
+        if variant != "float":
+            path = quantize(float_model, model_path, variant, calibration_inputs)
+        model = DialogueModel(
+            path,
+            config["ddconfig_path"],
+            config["selected_columns"],
+            config["target_columns"],
+            seq_length=config["seq_length"],
+            threads=args.threads,
+        )
+        metrics, selected = evaluate(model, test_inputs, test_targets, reference)
+        if variant == "float":
+            reference = selected
+        for batch_size in args.batch_sizes:
+            seconds = time_steps(model, test_inputs, batch_size, args.repeats)
+            rows.append(
+                {
+                    "model": os.path.basename(model_path).replace(".onnx", ""),
+                    "variant": variant,
+                    "size_kb": os.path.getsize(path) / 1e3,
+                    "batch_size": batch_size,
+                    "step_ms": seconds * 1e3,
+                    "windows_per_second": batch_size / seconds,
+                    "test_windows": len(test),
+                    **metrics,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def within_tolerance(report, max_accuracy_drop, max_l1):
+    """Whether each variant is as accurate as the float model, within tolerances"""
+    float_rows = report[report["variant"] == "float"].iloc[0]
+    ok = pd.Series(True, index=report.index)
+    for col in report.columns:
+        if col.endswith("_accuracy"):
+            ok &= report[col] >= float_rows[col] - max_accuracy_drop
+        elif col.endswith("_l1"):
+            ok &= report[col].fillna(0.0) <= max_l1
+    return ok
+
+
+if __name__ == "__main__":
+    import yaml
+
+    parser = argparse.ArgumentParser(
+        description="Quantizes the dialogue models to int8 and reports the latency "
+        "and accuracy of each variant"
+    )
+    parser.add_argument(
+        "--config-paths",
+        nargs="+",
+        default=[
+            "configs/infer.yaml",
+            "configs/infer-dialogue-script-best-5000.yaml",
+        ],
+        help="inference configs of the models to quantize; models that fail are "
+        "left out of the report",
+    )
+    parser.add_argument(
+        "--data-path",
+        default=None,
+        help="table the windows are taken from, by default the one the ddconfig "
+        "of each model was made from",
+    )
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=VARIANTS)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 16, 256])
+    parser.add_argument("--calibration-windows", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--max-accuracy-drop",
+        type=float,
+        default=0.01,
+        help="accuracy a variant may lose on any categorical column",
+    )
+    parser.add_argument(
+        "--max-l1",
+        type=float,
+        default=0.01,
+        help="mean absolute difference to the float model a variant may have on "
+        "any real column, in the units of the column",
+    )
+    parser.add_argument("--report-path", default=REPORT_PATH)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    reports = []
+    for config_path in args.config_paths:
+        with open(config_path, "r") as f:
+            config = yaml.safe_load(f)
+        try:
+            report = report_model(config, args, rng)
+        except Exception as e:
+            print(
+                f"Skipping {config_path}: {type(e).__name__}: {e}",
+                file=sys.stderr,
+            )
+            continue
+        report["within_tolerance"] = within_tolerance(
+            report, args.max_accuracy_drop, args.max_l1
+        )
+        reports.append(report)
+
+        print(report.to_string(index=False, float_format=lambda x: f"{x:.4g}"))
+        for batch_size, rows in report[report["within_tolerance"]].groupby(
+            "batch_size"
+        ):
+            best = rows.sort_values("step_ms").iloc[0]
+            print(
+                f"Fastest variant within tolerance at batch size {batch_size}: "
+                f"{best['variant']} ({best['step_ms']:.2f} ms per step)"
+            )
+        print()
+
+    if not reports:
+        sys.exit("No model could be quantized")
+    os.makedirs(os.path.dirname(args.report_path), exist_ok=True)
+    pd.concat(reports).to_csv(args.report_path, index=False)
+    print(f"Wrote {args.report_path}")
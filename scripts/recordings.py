@@ -0,0 +1,16 @@
+import numpy as np
+
+
+def sort_by_recording(data):
+    """Rows grouped by REC (in sorted order) and sorted by TsTo within each recording
+
+    Ties in TsTo are ordered the way rec_data.sort_values("TsTo") orders them for
+    each group of data.groupby("REC"), so outputs match the row by row scripts.
+    """
+    order = np.concatenate(
+        [
+            indices[np.argsort(data["TsTo"].values[indices], kind="quicksort")]
+            for indices in data.groupby("REC").indices.values()
+        ]
+    )
+    return data.iloc[order].reset_index(drop=True)
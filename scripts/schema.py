@@ -0,0 +1,55 @@
+import numpy as np
+
+# Coda values that are not coda types
+UNKNOWN = -1  # clicks that no coda template fits
+SILENCE = 98  # the whales of a dialogue column do not vocalize in the row
+VOCALIZATION_CHANGE = 99  # the pause between two vocalizations
+ORNAMENTATION = 100  # a surplus click between codas
+
+CODA = np.int8
+FLAG = np.uint8
+TIMING = np.float64
+
+# dtypes of the columns of the tables handed between the scripts. Real columns
+# stay float64, so that the CSV tables hold exactly the values of the float64
+# computations, and TsTo needs it anyway, as float32 resolves only about 0.1ms
+# at the times of the longest recordings.
+DTYPES = {
+    "REC": "category",
+    "nClicks": np.uint8,
+    "Whale": np.int16,
+    "TsTo": np.float64,
+    "Vocalization": np.int32,
+    "sequenceId": np.int32,
+    "itemPosition": np.int32,
+    "Coda": CODA,
+    "Coda1": CODA,
+    "Coda2": CODA,
+    "Ornamentation": FLAG,
+    "Ornamentation1": FLAG,
+    "Ornamentation2": FLAG,
+    "Synchrony": FLAG,
+    "Duration": TIMING,
+    "Duration1": TIMING,
+    "Duration2": TIMING,
+    "TimeDelta": np.float64,
+    **{f"ICI{i+1}": TIMING for i in range(28)},
+}
+# npy tables store durations and inter click intervals as float32. They are
+# recorded to 0.1 microseconds, which float32 keeps to within 0.1 microseconds,
+# but values read back from npy tables differ from the CSV ones in the last
+# digits.
+STORAGE_DTYPES = {
+    col: np.float32
+    for col in ["Duration", "Duration1", "Duration2"] + [f"ICI{i+1}" for i in range(28)]
+}
+
+
+def dtypes(columns):
+    """The schema dtypes of those of columns that are in the schema"""
+    return {col: DTYPES[col] for col in columns if col in DTYPES}
+
+
+def conform(data):
+    """data with the schema dtypes, for the columns that are in the schema"""
+    return data.astype(dtypes(data.columns))
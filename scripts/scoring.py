@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from inference import DialogueModel
+from tables import TableWriter
+from windows import WindowDataset
+
+
+def load_scoring_dataset(model, ddconfig_path, data_path, seq_length):
+    """Windows ending at every item but the first of each sequence of a table"""
+    with open(ddconfig_path, "r") as f:
+        ddconfig = json.loads(f.read())
+    dataset = WindowDataset.from_table(
+        data_path,
+        model.categorical_columns + model.real_columns,
+        seq_length,
+        seq_step_size=1,
+        min_padding=seq_length - 1,
+    )
+    dataset.check_encoding(ddconfig)
+    return dataset
+
+
+def score_windows(model, dataset, block_size=4096):
+    """Yields the scores of the next item of every window, in blocks of windows
+
+    Each block is a DataFrame with the sequenceId and step (index in the
+    sequence) of the scored items, their raw value in each target column, the
+    log probability the model gives to it for categorical columns, the absolute
+    difference to the predicted value for real columns, and in logprob the sum
+    of the log probabilities of the categorical columns. Only one block of
+    windows is materialised at a time.
+    """
+    padding = dataset.sequence_padding[dataset.window_sequences]
+    steps = dataset.window_subsequences + dataset.seq_length - padding
+    categorical = [col for col in model.target_columns if col in model.decoders]
+    for start in range(0, len(dataset), block_size):
+        indices = np.arange(start, min(start + block_size, len(dataset)))
+        # the first item of a sequence has no context to be predicted from
+        indices = indices[steps[indices] > 0]
+        if len(indices) == 0:
+            continue
+        inputs, targets = dataset.batch(indices)
+        outputs = model.run(
+            {
+                col: values.astype(np.int64 if col in model.encoders else np.float32)
+                for col, values in inputs.items()
+            }
+        )
+        rows = np.arange(len(indices))
+        scores = {
+            "sequenceId": dataset.sequence_ids[dataset.window_sequences[indices]],
+            "step": steps[indices],
+        }
+        for col in model.target_columns:
+            target = targets[col][:, -1]
+            scores[col] = model.decode(col, target)
+            if col in model.decoders:
+                scores[f"{col}_logprob"] = outputs[col][rows, target]
+            else:
+                scores[f"{col}_l1"] = np.abs(
+                    model.decode(col, outputs[col]) - scores[col]
+                )
+        scores["logprob"] = sum(scores[f"{col}_logprob"] for col in categorical)
+        yield pd.DataFrame(scores)
+
+
+class ScoreTotals:
+    """Running sums of step scores by the value of a column"""
+
+    def __init__(self, key):
+        self.key = key
+        self.sums = None
+
+    def add(self, scores):
+        columns = [col for col in scores.columns if col.endswith(("_logprob", "_l1"))]
+        block = scores.groupby(self.key)[columns + ["logprob"]].sum()
+        block["steps"] = scores.groupby(self.key).size()
+        self.sums = block if self.sums is None else self.sums.add(block, fill_value=0)
+
+    def table(self):
+        """Perplexity of each categorical column and of all of them together,
+        mean absolute error of each real column, and total log likelihood"""
+        sums = self.sums
+        table = pd.DataFrame({"steps": sums["steps"].astype(int)})
+        for col in sums.columns:
+            if col.endswith("_logprob"):
+                name = col[: -len("_logprob")]
+                table[f"{name}_perplexity"] = np.exp(-sums[col] / sums["steps"])
+            elif col.endswith("_l1"):
+                table[col] = sums[col] / sums["steps"]
+        table["perplexity"] = np.exp(-sums["logprob"] / sums["steps"])
+        table["log_likelihood"] = sums["logprob"]
+        return table.reset_index()
+
+
+def score(model, dataset, group_column, block_size=4096, steps_path=None):
+    """Per sequence and per group_column value score tables, in one pass"""
+    by_sequence, by_group = ScoreTotals("sequenceId"), ScoreTotals(group_column)
+    writer = TableWriter(steps_path) if steps_path is not None else None
+    try:
+        for scores in score_windows(model, dataset, block_size):
+            by_sequence.add(scores)
+            by_group.add(scores)
+            if writer is not None:
+                writer.write(scores)
+    finally:
+        if writer is not None:
+            writer.close()
+    return by_sequence.table(), by_group.table()
+
+
+if __name__ == "__main__":
+    import yaml
+
+    parser = argparse.ArgumentParser(
+        description="Scores every step of every sequence under a model, and "
+        "aggregates the scores by sequence and by coda type"
+    )
+    parser.add_argument(
+        "--config-path", default="configs/infer-dialogue-script-best-5000.yaml"
+    )
+    parser.add_argument("--model-path", default=None)
+    parser.add_argument(
+        "--data-path",
+        default=None,
+        help="table of sequences, by default the one the ddconfig was made from",
+    )
+    parser.add_argument(
+        "--group-column",
+        default=None,
+        help="target column the steps are also aggregated by, by default Coda or "
+        "the first categorical target column",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=4096,
+        help="number of windows scored at a time",
+    )
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument(
+        "--steps-path", default=None, help="also write the scores of every step here"
+    )
+    parser.add_argument("--output-directory", default="outputs/scores")
+    parser.add_argument(
+        "--top", type=int, default=10, help="number of least likely sequences shown"
+    )
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    model_path = args.model_path or config["model_path"]
+    model = DialogueModel(
+        model_path,
+        config["ddconfig_path"],
+        config["selected_columns"],
+        config["target_columns"],
+        seq_length=config["seq_length"],
+        threads=args.threads,
+    )
+    data_path = args.data_path or os.path.join(
+        "data", os.path.basename(config["ddconfig_path"]).replace(".json", ".csv")
+    )
+    categorical = [col for col in model.target_columns if col in model.decoders]
+    group_column = args.group_column or (
+        "Coda" if "Coda" in categorical else categorical[0]
+    )
+
+    dataset = load_scoring_dataset(
+        model, config["ddconfig_path"], data_path, config["seq_length"]
+    )
+    by_sequence, by_group = score(
+        model, dataset, group_column, args.block_size, args.steps_path
+    )
+
+    model_id = os.path.split(model_path)[1].replace(".onnx", "")
+    os.makedirs(args.output_directory, exist_ok=True)
+    sequences_path = os.path.join(args.output_directory, f"{model_id}-sequences.csv")
+    group_path = os.path.join(args.output_directory, f"{model_id}-{group_column}.csv")
+    by_sequence.to_csv(sequences_path, index=False)
+    by_group.to_csv(group_path, index=False)
+
+    steps = by_sequence["steps"].sum()
+    log_likelihood = by_sequence["log_likelihood"].sum()
+    print(
+        f"Scored {steps} steps of {len(by_sequence)} sequences, "
+        f"perplexity {np.exp(-log_likelihood / steps):.4g}"
+    )
+    print(f"Wrote {sequences_path} and {group_path}")
+    print("Least likely sequences (perplexity per step):")
+    print(
+        by_sequence.sort_values("perplexity", ascending=False)
+        .head(args.top)
+        .to_string(index=False, float_format=lambda x: f"{x:.4g}")
+    )
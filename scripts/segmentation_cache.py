@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+
+class SegmentationCache:
+    """On-disk cache of the best segmentation of vocalizations
+
+    Entries are keyed by a hash of the inter click intervals, the coda means file
+    and the segmentation parameters, so any change to the means or parameters
+    results in new keys. When more than max_entries are stored, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path, means_digest, max_entries=100000, **params):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS segmentations "
+            "(key TEXT PRIMARY KEY, path TEXT, score REAL, last_used INTEGER)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS segmentations_last_used "
+            "ON segmentations (last_used)"
+        )
+        self.prefix = json.dumps({"means": means_digest, **params}, sort_keys=True)
+        self.max_entries = max_entries
+        self.clock, self.size = self.connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0), COUNT(*) FROM segmentations"
+        ).fetchone()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def key(self, sequence):
+        hash_ = hashlib.sha256(self.prefix.encode())
+        hash_.update(np.asarray(sequence, dtype=np.float64).tobytes())
+        return hash_.hexdigest()
+
+    def get(self, sequence):
+        key = self.key(sequence)
+        row = self.connection.execute(
+            "SELECT path, score FROM segmentations WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.clock += 1
+        self.connection.execute(
+            "UPDATE segmentations SET last_used = ? WHERE key = ?", (self.clock, key)
+        )
+        path, score = row
+        return ([tuple(step) for step in json.loads(path)], score)
+
+    def put(self, sequence, best_path):
+        path, score = best_path
+        path = [(coda, int(start), int(end)) for coda, start, end in path]
+        self.clock += 1
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO segmentations VALUES (?, ?, ?, ?)",
+            (self.key(sequence), json.dumps(path), float(score), self.clock),
+        )
+        self.size += cursor.rowcount
+        if self.size > self.max_entries:
+            self.evict(self.size - self.max_entries)
+
+    def evict(self, n):
+        cursor = self.connection.execute(
+            "DELETE FROM segmentations WHERE key IN "
+            "(SELECT key FROM segmentations ORDER BY last_used LIMIT ?)",
+            (n,),
+        )
+        self.size -= cursor.rowcount
+        self.evictions += cursor.rowcount
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": self.size,
+        }
+
+    def close(self):
+        if self.size > self.max_entries:
+            self.evict(self.size - self.max_entries)
+        self.connection.commit()
+        self.connection.close()
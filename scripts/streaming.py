@@ -0,0 +1,224 @@
+import argparse
+import collections
+import importlib
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+extract_codas = importlib.import_module("0_extract_codas")
+
+CodaDecision = collections.namedtuple(
+    "CodaDecision", ["channel", "coda", "start", "end", "icis"]
+)
+CodaDecision.__doc__ = """A coda (or ornamentation, 100, or unknown, -1) of a channel
+
+start and end index the intervals of the current click train, like the paths
+of 0_extract_codas.py.
+"""
+
+
+class StreamingCodaDecoder:
+    """Segments inter click intervals into codas as they arrive, per channel
+
+    Each channel (e.g. a whale) buffers at most lookahead intervals. When one
+    more arrives, the buffered intervals are segmented as in 0_extract_codas.py
+    and the first segment of the best path is emitted, so every decision is made
+    at most lookahead intervals after its last interval arrived. end()
+    emits the rest of a click train. With a lookahead at least as long as a
+    click train, the decisions are those of the offline extraction, except that
+    intervals no coda fits are emitted as -1 rather than dropped, and except
+    for vocalizations of one channel that overlap in time. Their clicks arrive
+    interleaved on the same channel, which can not tell them apart. In
+    data/sperm-whale-dialogues.csv, this is the case for 2 of the 3840
+    vocalizations, where a last interval of 6.95s runs past the start of the
+    next vocalization of the same whale.
+
+    Every push after the first lookahead intervals of a click train segments
+    the whole buffer of lookahead + 1 intervals again, as emitting a segment
+    moves the root of the segmentation. A push therefore costs one
+    segmentation of lookahead + 1 intervals, which grows linearly with the
+    lookahead (about 0.5ms at 9 and 0.8ms at 18 intervals) and does not
+    depend on the length of the click train.
+    """
+
+    def __init__(
+        self,
+        means,
+        lookahead=18,
+        limit=100,
+        threshold=0.1,
+        only_equal=True,
+        extra_value=0.05,
+    ):
+        self.means = extract_codas.MeansMatrix(means)
+        self.coda_lengths = {k: len(v) for k, v in means.items()}
+        longest = max(self.coda_lengths.values())
+        if lookahead < longest:
+            raise ValueError(
+                f"the lookahead of {lookahead} intervals does not cover the longest "
+                f"coda of {longest} intervals"
+            )
+        self.lookahead = lookahead
+        self.params = {
+            "limit": limit,
+            "threshold": threshold,
+            "only_equal": only_equal,
+            "extra_value": extra_value,
+        }
+        # channel -> (buffered intervals, index of the first buffered interval)
+        self.channels = {}
+
+    def push(self, channel, ici):
+        """Adds an interval to a channel, and returns the decisions it allows"""
+        buffer, offset = self.channels.setdefault(channel, ([], 0))
+        buffer.append(ici)
+        if len(buffer) <= self.lookahead:
+            return []
+        return self.decide(channel, final=False)
+
+    def end(self, channel):
+        """Emits the decisions for the rest of a click train and resets the channel"""
+        if channel not in self.channels:
+            return []
+        decisions = self.decide(channel, final=True)
+        del self.channels[channel]
+        return decisions
+
+    def decide(self, channel, final):
+        buffer, offset = self.channels[channel]
+        if len(buffer) == 0:
+            return []
+        path, _ = extract_codas.segment_vocalization(
+            np.array(buffer), self.means, self.coda_lengths, **self.params
+        )
+        if path[0][0] is None:
+            # no coda fits the buffered intervals
+            path = [(None, 0, len(buffer) if final else 1)]
+        if not final:
+            path = path[:1]
+        decisions = [
+            CodaDecision(
+                channel,
+                -1 if coda is None else int(coda),
+                offset + start,
+                offset + end,
+                buffer[start:end],
+            )
+            for coda, start, end in path
+        ]
+        consumed = path[-1][2]
+        self.channels[channel] = (buffer[consumed:], offset + consumed)
+        return decisions
+
+
+def click_events(data, silence=1.0):
+    """(time, channel, ici) for every click after the first of each vocalization,
+    and (time, channel, None) when a vocalization ends, in time order
+
+    The end of a vocalization is signalled silence seconds after its last click,
+    or when the next vocalization of the same channel starts, if that is earlier.
+    """
+    icis = data[[f"ICI{i+1}" for i in range(28)]].values
+    channels = list(zip(data["REC"].values, data["Whale"].values))
+    ts_to = data["TsTo"].values
+    last_click = {}
+    events = []
+    for i, (channel, row) in enumerate(zip(channels, icis)):
+        row = row[row > 0]
+        times = ts_to[i] + np.cumsum(row)
+        events.extend((t, 1, i, channel, ici) for t, ici in zip(times, row))
+        last_click[i] = times[-1] if len(row) else ts_to[i]
+    next_start = {}
+    for i, channel in reversed(list(enumerate(channels))):
+        next_start[i] = next_start.get(channel, np.inf)
+        next_start[channel] = ts_to[i]
+    for i, channel in enumerate(channels):
+        end = max(last_click[i], min(last_click[i] + silence, next_start[i]))
+        events.append((end, 2, i, channel, None))
+    # at the same time, clicks come before ends, and vocalizations in file order
+    for t, _, i, channel, ici in sorted(events, key=lambda x: x[:3]):
+        yield t, i, channel, ici
+
+
+def replay(data, decoder, speed=0.0, silence=1.0):
+    """Yields (vocalization, decision) as the clicks of data are replayed
+
+    With speed > 0, clicks are fed at speed times their recorded rate,
+    otherwise as fast as possible. The channel of a vocalization is its
+    recording and whale.
+    """
+    start_wall, start_time = time.perf_counter(), None
+    vocalization_of = {}
+    for t, i, channel, ici in click_events(data, silence):
+        if speed > 0:
+            start_time = t if start_time is None else start_time
+            delay = (t - start_time) / speed - (time.perf_counter() - start_wall)
+            if delay > 0:
+                time.sleep(delay)
+        if ici is None:
+            decisions = decoder.end(channel)
+        else:
+            vocalization_of[channel] = i
+            decisions = decoder.push(channel, ici)
+        for decision in decisions:
+            yield vocalization_of[channel], decision
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replays a table of vocalizations through the streaming decoder"
+    )
+    parser.add_argument("--data-path", default="data/sperm-whale-dialogues.csv")
+    parser.add_argument("--lookahead", type=int, default=18)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0.0,
+        help="replay speed relative to the recordings, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--silence",
+        type=float,
+        default=1.0,
+        help="seconds without clicks after which a click train ends",
+    )
+    args = parser.parse_args()
+
+    with open("data/coda-means.json", "r") as f:
+        means = {k: np.array(v) for k, v in json.loads(f.read()).items()}
+    data = pd.read_csv(args.data_path)
+    decoder = StreamingCodaDecoder(means, lookahead=args.lookahead)
+
+    start = time.perf_counter()
+    streamed = collections.defaultdict(list)
+    for vocalization, decision in replay(data, decoder, args.speed, args.silence):
+        streamed[vocalization].append((decision.coda, decision.start, decision.end))
+    seconds = time.perf_counter() - start
+
+    # offline segmentation of the same vocalizations for comparison
+    offline = extract_codas.segment_vocalizations(
+        extract_codas.get_sequences(data),
+        means,
+        limit=100,
+        threshold=0.1,
+        only_equal=True,
+        extra_value=0.05,
+    )
+    offline = {
+        i: (
+            [(int(coda), start, end) for coda, start, end in path]
+            if path[0][0] is not None
+            else [(-1, 0, len(sequence))] if len(sequence) else []
+        )
+        for i, ((path, _), sequence) in enumerate(
+            zip(offline, extract_codas.get_sequences(data))
+        )
+    }
+    same = sum(streamed.get(i, []) == path for i, path in offline.items())
+    print(
+        f"Streamed {sum(map(len, streamed.values()))} decisions in {seconds:.2f}s, "
+        f"{same} of {len(offline)} vocalizations segmented as offline "
+        f"with a lookahead of {args.lookahead} intervals"
+    )
@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+from schema import STORAGE_DTYPES
+
+FORMATS = ["csv", "npy"]
+NPY_HEADER_SIZE = 128
+
+
+def table_path(path, format="csv"):
+    """Path of the table named by a .csv path, in the given format
+
+    npy tables are directories with one .npy file per column, which are memory
+    mapped when read. String columns are stored as int32 codes into a list of
+    categories in {column}.categories.json.
+    """
+    stem, _ = os.path.splitext(path)
+    stem = stem[: -len(".columns")] if stem.endswith(".columns") else stem
+    return {"csv": f"{stem}.csv", "npy": f"{stem}.columns"}[format]
+
+
+def npy_header(dtype, length):
+    """A .npy header of fixed size, so that it can be rewritten as rows are added"""
+    header = repr(
+        {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": (length,),
+        }
+    ).encode("latin1")
+    padding = NPY_HEADER_SIZE - 10 - len(header) - 1
+    return (
+        b"\x93NUMPY\x01\x00"
+        + struct.pack("<H", NPY_HEADER_SIZE - 10)
+        + header
+        + b" " * padding
+        + b"\n"
+    )
+
+
+def read_npy_columns(path, columns=None, dtype=None):
+    """Columns of an npy table, cast to the dtypes given by column in dtype
+
+    String columns with a "category" dtype are read as categoricals with
+    sorted categories, like pd.read_csv reads them, without building the
+    strings of every row.
+    """
+    dtype = dtype or {}
+    with open(os.path.join(path, "columns.json"), "r") as f:
+        all_columns = json.loads(f.read())
+    values = {}
+    for col in all_columns if columns is None else columns:
+        values[col] = np.load(os.path.join(path, f"{col}.npy"), mmap_mode="r")
+        categories_path = os.path.join(path, f"{col}.categories.json")
+        if os.path.exists(categories_path):
+            with open(categories_path, "r") as f:
+                categories = np.array(json.loads(f.read()), dtype=object)
+            if dtype.get(col) == "category":
+                values[col] = pd.Categorical.from_codes(
+                    values[col], categories
+                ).set_categories(sorted(categories))
+            else:
+                values[col] = categories[values[col]]
+        elif col in dtype and dtype[col] != "category":
+            values[col] = values[col].astype(dtype[col], copy=False)
+    return values
+
+
+def read_table(path, format="csv", columns=None, dtype=None):
+    """The table named by a .csv path as a DataFrame, optionally only columns
+
+    dtype maps columns to the dtype they are read as, see schema.DTYPES.
+    """
+    path = table_path(path, format)
+    if format == "csv":
+        return pd.read_csv(path, usecols=columns, dtype=dtype)
+    return pd.DataFrame(read_npy_columns(path, columns, dtype), copy=False)
+
+
+def read_table_chunks(path, format="csv", chunksize=100000, columns=None, dtype=None):
+    """Yields the table named by a .csv path in DataFrames of chunksize rows"""
+    path = table_path(path, format)
+    if format == "csv":
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunksize, dtype=dtype)
+        return
+    values = read_npy_columns(path, columns, dtype)
+    n = len(next(iter(values.values()))) if len(values) else 0
+    for start in range(0, n, chunksize):
+        yield pd.DataFrame(
+            {col: v[start : start + chunksize] for col, v in values.items()},
+            index=pd.RangeIndex(start, min(start + chunksize, n)),
+            copy=False,
+        )
+
+
+class TableWriter:
+    """Writes DataFrames with the same columns one after the other to a table"""
+
+    def __init__(self, path, format="csv"):
+        self.path = table_path(path, format)
+        self.format = format
+        self.columns = None
+        self.files, self.dtypes, self.lengths, self.categories = {}, {}, {}, {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        first = self.columns is None
+        if first:
+            self.columns = list(data.columns)
+        if self.format == "csv":
+            data.to_csv(
+                self.path, index=False, mode="w" if first else "a", header=first
+            )
+            return
+        if first:
+            os.makedirs(self.path, exist_ok=True)
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
+        for col in self.columns:
+            if isinstance(data[col].dtype, pd.CategoricalDtype):
+                # maps the categories rather than the string of every row
+                categories = self.categories.setdefault(col, {})
+                codes = np.array(
+                    [
+                        categories.setdefault(v, len(categories))
+                        for v in data[col].cat.categories
+                    ],
+                    dtype=np.int32,
+                )
+                values = codes[data[col].cat.codes.to_numpy()]
+            else:
+                values = data[col].to_numpy()
+            if values.dtype.kind not in "biuf":
+                categories = self.categories.setdefault(col, {})
+                values = np.array(
+                    [categories.setdefault(v, len(categories)) for v in values],
+                    dtype=np.int32,
+                )
+            if first:
+                self.dtypes[col] = (
+                    STORAGE_DTYPES.get(col, values.dtype)
+                    if values.dtype.kind == "f"
+                    else values.dtype
+                )
+                self.lengths[col] = 0
+                self.files[col] = open(os.path.join(self.path, f"{col}.npy"), "wb")
+                self.files[col].write(npy_header(values.dtype, 0))
+            self.files[col].write(
+                np.ascontiguousarray(values, dtype=self.dtypes[col]).tobytes()
+            )
+            self.lengths[col] += len(values)
+
+    def close(self):
+        if self.format != "npy" or self.columns is None:
+            return
+        for col, f in self.files.items():
+            f.seek(0)
+            f.write(npy_header(self.dtypes[col], self.lengths[col]))
+            f.close()
+        for col, categories in self.categories.items():
+            with open(os.path.join(self.path, f"{col}.categories.json"), "w") as f:
+                f.write(json.dumps(list(categories)))
+        with open(os.path.join(self.path, "columns.json"), "w") as f:
+            f.write(json.dumps(self.columns))
+        self.files = {}
+
+
+def write_table(data, path, format="csv"):
+    with TableWriter(path, format) as writer:
+        writer.write(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts a table between the csv and npy formats"
+    )
+    parser.add_argument("path")
+    parser.add_argument("--read-format", choices=FORMATS, default="csv")
+    parser.add_argument("--write-format", choices=FORMATS, default="npy")
+    parser.add_argument("--chunksize", type=int, default=100000)
+    args = parser.parse_args()
+
+    with TableWriter(args.path, args.write_format) as writer:
+        for chunk in read_table_chunks(args.path, args.read_format, args.chunksize):
+            writer.write(chunk)
+    print(f"Wrote {table_path(args.path, args.write_format)}")
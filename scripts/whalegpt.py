@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import argparse
+import builtins
+import collections
+import os
+import runpy
+import sys
+import time
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# subcommand -> (script, description)
+COMMANDS = {
+    "means": ("00_create_coda_means.py", "create the coda templates"),
+    "extract": ("0_extract_codas.py", "extract codas from click sequences"),
+    "dialogue": ("1a_create_dialogue.py", "create the dialogue table"),
+    "script": ("1b_create_dialogue_script.py", "create the dialogue script table"),
+    "render": ("1c_generate_readable_text.py", "render a script table as text"),
+    "infer": ("inference.py", "generate dialogues with an onnx model"),
+    "pipeline": ("pipeline.py", "run the pipeline stages that are not up to date"),
+    "stream": ("streaming.py", "replay vocalizations through the streaming decoder"),
+    "score": ("scoring.py", "score every step of every sequence under a model"),
+    "quantize": ("quantize.py", "quantize the models and report latency"),
+    "windows": ("windows.py", "build or export the training windows"),
+    "serve": ("generation_service.py", "serve generation requests"),
+    "benchmark": ("benchmark.py", "time the pipeline on synthetic data"),
+    "convert": ("tables.py", "convert a table to another format"),
+}
+
+
+class ImportTimer:
+    """Seconds spent in import statements while active, by top level module
+
+    Only the outermost of nested imports is timed, so the imports of a package
+    count towards the package. Modules already imported cost nothing.
+    """
+
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.depth = 0
+
+    def __enter__(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.__import__ = self.original_import
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if self.depth > 0 or level > 0 or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            self.seconds[name.split(".")[0]] += time.perf_counter() - start
+
+    def summary(self, top=5):
+        modules = ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in self.seconds.most_common(top)
+        )
+        return f"import time: {sum(self.seconds.values()):.3f}s ({modules})"
+
+
+def run_command(command, args, import_time=False):
+    """Runs the script of a subcommand as __main__ with args as its arguments
+
+    Nothing but the standard library is imported before, so each subcommand
+    only pays for the imports of its own script.
+    """
+    path = os.path.join(SCRIPTS_DIRECTORY, COMMANDS[command][0])
+    sys.argv = [path] + list(args)
+    if not import_time:
+        runpy.run_path(path, run_name="__main__")
+        return
+    start = time.perf_counter()
+    timer = ImportTimer()
+    try:
+        with timer:
+            runpy.run_path(path, run_name="__main__")
+    finally:
+        print(
+            f"{command}: {timer.summary()}, "
+            f"{time.perf_counter() - start:.3f}s in total",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="whalegpt",
+        description="Runs the scripts of the repository as subcommands, e.g. "
+        "`whalegpt extract --workers 4`, importing only what the subcommand needs",
+        epilog="commands:\n"
+        + "\n".join(
+            f"  {name:<10} {description}" for name, (_, description) in COMMANDS.items()
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--import-time",
+        action="store_true",
+        help="report the seconds spent importing modules on stderr",
+    )
+    parser.add_argument("command", choices=COMMANDS, metavar="command")
+    parser.add_argument(
+        "args", nargs=argparse.REMAINDER, help="arguments of the command"
+    )
+    args = parser.parse_args()
+
+    run_command(args.command, args.args, args.import_time)
@@ -0,0 +1,358 @@
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from tables import FORMATS, TableWriter, read_table
+
+
+def subsequence_starts(in_seq_length, seq_length, seq_step_size):
+    """Window starts of a sequence, as sequifier preprocess computes them
+
+    The step is adjusted so that the last window ends at the end of the sequence.
+    """
+    nseq_adjusted = math.ceil((in_seq_length - seq_length) / seq_step_size)
+    seq_step_size_adjusted = math.floor(
+        (in_seq_length - seq_length) / max(1, nseq_adjusted)
+    )
+    increments = [0] + [max(1, seq_step_size_adjusted)] * nseq_adjusted
+    while np.sum(increments) < (in_seq_length - seq_length):
+        increments[np.argmin(increments[1:]) + 1] += 1
+    return np.cumsum(increments)
+
+
+def encode_columns(data, columns):
+    """Values of columns encoded as sequifier preprocess encodes them
+
+    Integer and string columns are mapped to ids from 1 in sorted order, float
+    columns are scaled to [-0.8, 0.8]. Returns the encoded arrays, the id maps and
+    the min and max values.
+    """
+    encoded, id_maps, min_max_values = {}, {}, {}
+    for col in columns:
+        values = data[col].to_numpy()
+        if values.dtype.kind == "f":
+            # npy tables store some real columns as float32, sequifier scales
+            # them in float64, and the ddconfig takes python floats
+            values = values.astype(np.float64)
+            min_val, max_val = float(np.min(values)), float(np.max(values))
+            encoded[col] = ((values - min_val) / (max_val - min_val)) * 1.6 - 0.8
+            min_max_values[col] = {"min": min_val, "max": max_val}
+        elif values.dtype.kind in "iuOSUT":
+            uniques, codes = np.unique(values, return_inverse=True)
+            encoded[col] = (codes + 1).astype(np.int32)
+            id_maps[col] = {
+                (v if isinstance(v, str) else int(v)): i + 1
+                for i, v in enumerate(uniques)
+            }
+        else:
+            raise ValueError(f"Column {col} has unsupported dtype: {values.dtype}")
+    return encoded, id_maps, min_max_values
+
+
+class WindowDataset:
+    """The overlapping windows of a table of sequences, without materialising them
+
+    Each column is held once, as a contiguous array of the encoded values of all
+    sequences one after the other, sequences shorter than a window left padded
+    with 0 like sequifier pads them. A window is seq_length + 1 items, the model
+    inputs followed by the last target, and windows are read as rows of a
+    strided view of these arrays, so a window costs one start offset rather
+    than seq_length + 1 values per column. Subsets returned by split() share the
+    arrays.
+    """
+
+    def __init__(
+        self,
+        values,
+        seq_length,
+        window_starts,
+        window_sequences,
+        window_subsequences,
+        sequence_ids,
+        sequence_padding,
+        id_maps,
+        min_max_values,
+    ):
+        self.values = values
+        self.columns = list(values)
+        self.seq_length = seq_length
+        self.window_starts = window_starts
+        self.window_sequences = window_sequences
+        self.window_subsequences = window_subsequences
+        self.sequence_ids = sequence_ids
+        self.sequence_padding = sequence_padding
+        self.id_maps = id_maps
+        self.min_max_values = min_max_values
+        self.views = {
+            col: np.lib.stride_tricks.sliding_window_view(v, seq_length + 1)
+            for col, v in values.items()
+        }
+
+    @classmethod
+    def from_data(cls, data, columns, seq_length, seq_step_size=1, min_padding=0):
+        """Windows of a DataFrame with sequenceId and itemPosition columns
+
+        min_padding zeros are put before every sequence, so that with a
+        min_padding of seq_length - 1 and a step of 1 every item but the first
+        is the last item of exactly one window.
+        """
+        encoded, id_maps, min_max_values = encode_columns(data, columns)
+        order = np.lexsort((data["itemPosition"].values, data["sequenceId"].values))
+        sequence_ids, first, lengths = np.unique(
+            data["sequenceId"].values[order], return_index=True, return_counts=True
+        )
+        window_length = seq_length + 1
+        padded = np.maximum(lengths + min_padding, window_length)
+        offsets = np.cumsum(padded) - padded
+        destination = np.empty(len(order), dtype=np.int64)
+        destination[order] = np.repeat(
+            offsets + padded - lengths - first, lengths
+        ) + np.arange(len(order))
+        values = {}
+        for col, v in encoded.items():
+            values[col] = np.zeros(padded.sum(), dtype=v.dtype)
+            values[col][destination] = v
+
+        starts = [subsequence_starts(n, window_length, seq_step_size) for n in padded]
+        n_windows = np.array([len(s) for s in starts])
+        return cls(
+            values,
+            seq_length,
+            np.concatenate(starts) + np.repeat(offsets, n_windows),
+            np.repeat(np.arange(len(sequence_ids)), n_windows),
+            np.concatenate([np.arange(n) for n in n_windows]),
+            sequence_ids,
+            padded - lengths,
+            id_maps,
+            min_max_values,
+        )
+
+    @classmethod
+    def from_table(
+        cls,
+        path,
+        columns,
+        seq_length,
+        seq_step_size=1,
+        format="csv",
+        max_rows=None,
+        min_padding=0,
+    ):
+        data = read_table(path, format, ["sequenceId", "itemPosition"] + columns)
+        if max_rows:
+            data = data.head(int(max_rows))
+        return cls.from_data(data, columns, seq_length, seq_step_size, min_padding)
+
+    def check_encoding(self, ddconfig):
+        """Raises a ValueError if a column is encoded differently from a ddconfig"""
+        for col, id_map in self.id_maps.items():
+            if {str(k): v for k, v in id_map.items()} != ddconfig["id_maps"][col]:
+                raise ValueError(f"{col} is encoded differently from the ddconfig")
+        for col, min_max in self.min_max_values.items():
+            if min_max != ddconfig["min_max_values"][col]:
+                raise ValueError(f"{col} is scaled differently from the ddconfig")
+
+    def __len__(self):
+        return len(self.window_starts)
+
+    def __getitem__(self, i):
+        """The window i, as a read-only view of each column"""
+        return {col: view[self.window_starts[i]] for col, view in self.views.items()}
+
+    def batch(self, indices):
+        """Model inputs and targets of the windows at indices, as (n, seq_length) arrays"""
+        starts = self.window_starts[indices]
+        windows = {col: view[starts] for col, view in self.views.items()}
+        return (
+            {col: w[:, :-1] for col, w in windows.items()},
+            {col: w[:, 1:] for col, w in windows.items()},
+        )
+
+    def subset(self, mask):
+        return WindowDataset(
+            self.values,
+            self.seq_length,
+            self.window_starts[mask],
+            self.window_sequences[mask],
+            self.window_subsequences[mask],
+            self.sequence_ids,
+            self.sequence_padding,
+            self.id_maps,
+            self.min_max_values,
+        )
+
+    def split_groups(self, group_proportions, by="position"):
+        """The group of each window for group_proportions
+
+        by="position" splits the windows of every sequence like sequifier: the
+        first windows of a sequence go to the first group and so on, each group
+        getting the floor of its share and the first group the rest. by="sequence"
+        instead assigns whole sequences, in sequenceId order, so that no sequence
+        contributes to two groups.
+        """
+        assert abs(1.0 - np.sum(group_proportions)) < 1e-13, np.sum(group_proportions)
+        n_windows = np.bincount(self.window_sequences, minlength=len(self.sequence_ids))
+        if by == "position":
+            sizes = np.array(
+                [[math.floor(n * p) for p in group_proportions] for n in n_windows],
+                dtype=np.int64,
+            ).reshape(len(n_windows), len(group_proportions))
+            sizes[:, 0] += n_windows - sizes.sum(axis=1)
+            bounds = np.cumsum(sizes, axis=1)[self.window_sequences]
+            # windows are in sequence order, so this is the rank within a sequence
+            rank = np.arange(len(self)) - np.searchsorted(
+                self.window_sequences, self.window_sequences
+            )
+            return (rank[:, None] >= bounds).sum(axis=1)
+        if by == "sequence":
+            before = np.cumsum(n_windows) - n_windows
+            bounds = np.cumsum(group_proportions)[:-1] * n_windows.sum()
+            groups = np.searchsorted(bounds, before, side="right")
+            return groups[self.window_sequences]
+        raise ValueError(f"unknown split {by}, expected position or sequence")
+
+    def split(self, group_proportions, by="position"):
+        """Subsets of the windows of each group, sharing the arrays of this dataset"""
+        groups = self.split_groups(group_proportions, by)
+        return [self.subset(groups == i) for i in range(len(group_proportions))]
+
+    def nbytes(self):
+        return sum(v.nbytes for v in self.values.values()) + sum(
+            a.nbytes
+            for a in (
+                self.window_starts,
+                self.window_sequences,
+                self.window_subsequences,
+            )
+        )
+
+    def ddconfig(self, split_paths):
+        """The data driven config sequifier preprocess writes for this data"""
+        return {
+            "n_classes": {col: len(m) + 1 for col, m in self.id_maps.items()},
+            "id_maps": self.id_maps,
+            "split_paths": split_paths,
+            "column_types": {
+                col: "int64" if col in self.id_maps else "float64"
+                for col in self.columns
+            },
+            "min_max_values": self.min_max_values,
+        }
+
+    def write_sequifier(self, path, chunksize=10000):
+        """Writes the windows in the layout of a sequifier split file
+
+        One row per window and column, with sequenceId, subsequenceId, inputCol
+        and the values of the window from "{seq_length}" (first) to "0" (last).
+        """
+        # like pandas, sequifier writes all values as floats if any column is real
+        dtype = np.int64 if len(self.min_max_values) == 0 else np.float64
+        value_columns = [str(c) for c in range(self.seq_length, -1, -1)]
+        with TableWriter(path, "csv") as writer:
+            for start in range(0, max(len(self), 1), chunksize):
+                indices = np.arange(start, min(start + chunksize, len(self)))
+                starts = self.window_starts[indices]
+                windows = np.stack(
+                    [self.views[col][starts] for col in self.columns], axis=1
+                )
+                n = len(indices) * len(self.columns)
+                chunk = pd.DataFrame(
+                    {
+                        "sequenceId": np.repeat(
+                            self.sequence_ids[self.window_sequences[indices]],
+                            len(self.columns),
+                        ),
+                        "subsequenceId": np.repeat(
+                            self.window_subsequences[indices], len(self.columns)
+                        ),
+                        "inputCol": np.tile(self.columns, len(indices)),
+                    }
+                )
+                values = windows.reshape(n, self.seq_length + 1).astype(dtype)
+                padding = np.repeat(
+                    self.sequence_padding[self.window_sequences[indices]],
+                    len(self.columns),
+                )
+                if dtype == np.float64 and padding.any():
+                    # sequifier pads with integers, which stay integers in the
+                    # columns of a sequence that hold nothing else
+                    values = values.astype(object)
+                    values[np.arange(self.seq_length + 1) < padding[:, None]] = 0
+                chunk = pd.concat(
+                    [chunk, pd.DataFrame(values, columns=value_columns)], axis=1
+                )
+                writer.write(chunk)
+
+    def export_sequifier(
+        self, project_path, data_name_root, group_proportions, chunksize=10000
+    ):
+        """Writes the split files and data driven config of sequifier preprocess"""
+        split_paths = [
+            os.path.join(project_path, "data", f"{data_name_root}-split{i}.csv")
+            for i in range(len(group_proportions))
+        ]
+        ddconfig_path = os.path.join(
+            project_path, "configs", "ddconfigs", f"{data_name_root}.json"
+        )
+        os.makedirs(os.path.dirname(ddconfig_path), exist_ok=True)
+        # the ddconfig is written first, so that a config that cannot be
+        # serialized leaves no split files behind
+        ddconfig = json.dumps(self.ddconfig(split_paths))
+        with open(ddconfig_path, "w") as f:
+            f.write(ddconfig)
+        os.makedirs(os.path.join(project_path, "data"), exist_ok=True)
+        for path, subset in zip(split_paths, self.split(group_proportions)):
+            subset.write_sequifier(path, chunksize)
+        return split_paths
+
+
+if __name__ == "__main__":
+    import yaml
+
+    parser = argparse.ArgumentParser(
+        description="Builds the windows of a preprocess config without writing them, "
+        "or exports them as sequifier split files"
+    )
+    parser.add_argument("--config-path", default="configs/preprocess.yaml")
+    parser.add_argument("--read-format", choices=FORMATS, default="csv")
+    parser.add_argument("--split-by", choices=["position", "sequence"], default=None)
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="write the split files and data driven config of sequifier preprocess",
+    )
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as f:
+        config = yaml.safe_load(f)
+    columns = [
+        col
+        for col in config["selected_columns"]
+        if col not in ["sequenceId", "itemPosition"]
+    ]
+    dataset = WindowDataset.from_table(
+        config["data_path"],
+        columns,
+        config["seq_length"],
+        config.get("seq_step_size", config["seq_length"]),
+        args.read_format,
+        config.get("max_rows"),
+    )
+    splits = dataset.split(config["group_proportions"], args.split_by or "position")
+    print(
+        f"{len(dataset)} windows of {config['seq_length'] + 1} items in "
+        f"{dataset.nbytes() / 1e6:.1f} MB, "
+        f"{[len(split) for split in splits]} windows per split"
+    )
+    if args.export:
+        if args.split_by not in (None, "position"):
+            parser.error("sequifier split files are split by position")
+        data_name_root = os.path.splitext(os.path.basename(config["data_path"]))[0]
+        for path in dataset.export_sequifier(
+            config["project_path"], data_name_root, config["group_proportions"]
+        ):
+            print(f"Wrote {path}")
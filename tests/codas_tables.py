@@ -0,0 +1,53 @@
+import pandas as pd
+
+from schema import DTYPES, ORNAMENTATION, UNKNOWN
+
+CODAS_PATH = "data/sperm-whale-dialogues-codas-manhattan.csv"
+
+
+def codas(rows):
+    """A codas table of (REC, Whale, TsTo, Vocalization, Coda, Duration) rows"""
+    return pd.DataFrame(
+        rows, columns=["REC", "Whale", "TsTo", "Vocalization", "Coda", "Duration"]
+    ).astype({"REC": "category", "Whale": DTYPES["Whale"], "Coda": DTYPES["Coda"]})
+
+
+EDGE_CASES = {
+    "ties in TsTo": codas(
+        [
+            ("a", 1, 1.0, 0, 3, 0.5),
+            ("a", 2, 1.0, 1, 4, 0.6),
+            ("a", 3, 1.0, 2, 5, 0.7),
+            ("a", 1, 1.0, 3, 6, 0.8),
+            ("a", 2, 2.0, 4, 3, 0.5),
+        ]
+    ),
+    "several whales": codas(
+        [
+            ("a", 1, 0.0, 0, 3, 0.5),
+            ("a", 2, 0.1, 1, 4, 0.6),
+            ("a", 3, 0.2, 2, 5, 0.7),
+            ("a", 1, 0.35, 3, 6, 0.8),
+            ("a", 2, 5.0, 4, 3, 0.5),
+            ("a", 3, 5.2, 5, 4, 0.5),
+        ]
+    ),
+    "single row recordings": codas(
+        [
+            ("c", 1, 3.0, 0, 3, 0.5),
+            ("a", 2, 1.0, 1, 4, 0.6),
+            ("b", 1, 2.0, 2, ORNAMENTATION, 0.1),
+        ]
+    ),
+    "vocalization changes": codas(
+        [
+            ("a", 1, 0.0, 0, 3, 0.5),
+            ("a", 1, 0.5, 0, ORNAMENTATION, 0.05),
+            ("a", 1, 0.55, 0, 4, 0.6),
+            ("a", 2, 0.6, 1, UNKNOWN, 0.3),
+            ("a", 2, 2.0, 2, 5, 0.4),
+            ("a", 1, 2.1, 3, 5, 0.4),
+            ("a", 1, 2.5, 3, ORNAMENTATION, 0.02),
+        ]
+    ),
+}
@@ -0,0 +1,31 @@
+import importlib
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+from codas_tables import CODAS_PATH, EDGE_CASES
+from schema import DTYPES
+
+create_dialogue_script = importlib.import_module("1b_create_dialogue_script")
+
+
+def assert_same_scripts(data):
+    expected = create_dialogue_script.build_dialogue_script_iterrows(data)
+    script = create_dialogue_script.build_dialogue_script(data)
+    pd.testing.assert_frame_equal(script, expected)
+
+
+def test_matches_iterrows_on_bundled_codas():
+    data = pd.read_csv(
+        os.path.join(ROOT, CODAS_PATH),
+        usecols=create_dialogue_script.CODA_COLUMNS,
+        dtype=DTYPES,
+    )
+    assert_same_scripts(data)
+
+
+@pytest.mark.parametrize("case", EDGE_CASES)
+def test_matches_iterrows_on_edge_cases(case):
+    assert_same_scripts(EDGE_CASES[case])
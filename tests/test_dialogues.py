@@ -0,0 +1,31 @@
+import importlib
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+from codas_tables import CODAS_PATH, EDGE_CASES
+from schema import DTYPES
+
+create_dialogue = importlib.import_module("1a_create_dialogue")
+
+
+def assert_same_dialogues(data):
+    expected = create_dialogue.build_dialogues_iterrows(data)
+    dialogues = create_dialogue.build_dialogues(data)
+    pd.testing.assert_frame_equal(dialogues, expected)
+
+
+def test_matches_iterrows_on_bundled_codas():
+    data = pd.read_csv(
+        os.path.join(ROOT, CODAS_PATH),
+        usecols=create_dialogue.CODA_COLUMNS,
+        dtype=DTYPES,
+    )
+    assert_same_dialogues(data)
+
+
+@pytest.mark.parametrize("case", EDGE_CASES)
+def test_matches_iterrows_on_edge_cases(case):
+    assert_same_dialogues(EDGE_CASES[case])
@@ -0,0 +1,99 @@
+import importlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+
+extract_codas = importlib.import_module("0_extract_codas")
+benchmark = importlib.import_module("benchmark")
+
+
+@pytest.fixture(scope="module")
+def means():
+    with open(os.path.join(ROOT, "data/coda-means.json"), "r") as f:
+        return {k: np.array(v) for k, v in json.loads(f.read()).items()}
+
+
+@pytest.fixture(scope="module")
+def real_sequences():
+    data = pd.read_csv(os.path.join(ROOT, "data/sperm-whale-dialogues.csv"))
+    return extract_codas.get_sequences(data)
+
+
+@pytest.fixture(scope="module")
+def synthetic_sequences(means):
+    data = benchmark.generate_dialogues(500, means, seed=1)
+    return extract_codas.get_sequences(data)
+
+
+EDGE_CASES = [
+    np.array([]),
+    np.array([0.2]),
+    np.array([0.2, 0.2]),
+    np.array([5.0, 0.01, 3.0]),
+    np.full(28, 0.05),
+]
+
+
+def segment(sequence, means, engine, matrix=None, **params):
+    if matrix is None:
+        matrix = extract_codas.MeansMatrix(means)
+    coda_lengths = {k: len(v) for k, v in means.items()}
+    path, score, *_ = extract_codas.segment_vocalization(
+        sequence, matrix, coda_lengths, engine=engine, **params
+    )
+    return path, score
+
+
+def assert_same_segmentations(sequences, means, **params):
+    for sequence in sequences:
+        tree_path, tree_score = segment(sequence, means, "tree", **params)
+        for engine in ["dp", "bnb"]:
+            path, score = segment(sequence, means, engine, **params)
+            assert path == tree_path, (engine, list(sequence))
+            assert score == pytest.approx(tree_score), (engine, list(sequence))
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"only_equal": False},
+        {"limit": 3},
+        {"limit": 1, "threshold": 0.2},
+        {"extra_value": 0.5},
+    ],
+)
+def test_engines_agree_on_real_click_trains(real_sequences, means, params):
+    # every 4th vocalization, and all of the longest ones, where engines differ most
+    sequences = real_sequences[::4] + [s for s in real_sequences if len(s) > 20]
+    assert_same_segmentations(sequences, means, **params)
+
+
+@pytest.mark.parametrize("params", [{}, {"only_equal": False, "limit": 3}])
+def test_engines_agree_on_synthetic_click_trains(synthetic_sequences, means, params):
+    assert_same_segmentations(synthetic_sequences, means, **params)
+
+
+def test_engines_agree_on_edge_cases(means):
+    assert_same_segmentations(EDGE_CASES, means)
+
+
+@pytest.mark.parametrize("params", [{}, {"only_equal": False, "limit": 3}])
+def test_template_index_matches_scan(real_sequences, means, monkeypatch, params):
+    scan = extract_codas.MeansMatrix(means)
+    # the bundled means have too few templates of each length for an index
+    monkeypatch.setattr(extract_codas.MeansMatrix, "INDEX_MIN_TEMPLATES", 1)
+    indexed = extract_codas.MeansMatrix(means)
+    assert len(scan.indexes) == 0 and len(indexed.indexes) == len(indexed.buckets)
+
+    for sequence in real_sequences[::4] + EDGE_CASES:
+        for engine in ["dp", "tree"]:
+            path, score = segment(sequence, means, engine, indexed, **params)
+            scan_path, scan_score = segment(sequence, means, engine, scan, **params)
+            assert path == scan_path, (engine, list(sequence))
+            assert score == pytest.approx(scan_score), (engine, list(sequence))
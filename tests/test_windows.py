@@ -0,0 +1,43 @@
+import json
+import os
+
+import pandas as pd
+
+from conftest import ROOT
+from schema import DTYPES, dtypes
+from tables import write_table
+from windows import WindowDataset
+
+COLUMNS = [
+    "Coda1",
+    "Ornamentation1",
+    "Duration1",
+    "Coda2",
+    "Ornamentation2",
+    "Duration2",
+]
+
+
+def test_export_from_npy_table(tmp_path):
+    data = pd.read_csv(os.path.join(ROOT, "data/whale-dialogues.csv"), nrows=2000)
+    data = data.astype(dtypes(data.columns))
+    path = str(tmp_path / "whale-dialogues.csv")
+    write_table(data, path, "npy")
+
+    dataset = WindowDataset.from_table(path, COLUMNS, 25, 1, "npy")
+    split_paths = dataset.export_sequifier(
+        str(tmp_path), "whale-dialogues", [0.8, 0.1, 0.1]
+    )
+
+    with open(tmp_path / "configs" / "ddconfigs" / "whale-dialogues.json") as f:
+        ddconfig = json.load(f)
+    assert ddconfig["split_paths"] == split_paths
+    assert set(ddconfig["min_max_values"]) == {"Duration1", "Duration2"}
+    assert all(os.path.exists(path) for path in split_paths)
+    # the ddconfig read back describes the encoding of the exported windows
+    dataset.check_encoding(ddconfig)
+
+    csv_dataset = WindowDataset.from_data(data, COLUMNS, 25, 1)
+    for col, min_max in csv_dataset.min_max_values.items():
+        for key, value in min_max.items():
+            assert abs(ddconfig["min_max_values"][col][key] - value) < 1e-6